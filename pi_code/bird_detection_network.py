@@ -1,5 +1,7 @@
+import os
 from pathlib import Path
-from typing import List
+from time import perf_counter
+from typing import List, Optional
 
 import cv2
 import numpy as np
@@ -19,17 +21,28 @@ class BirdDetectionNetwork:
     GRAPH_FILE_NAME = "detect.tflite"
     LABELS_FILE_NAME = "labelmap.txt"
 
-    def __init__(self):
+    DEFAULT_NUM_THREADS = os.cpu_count() or 1
+    WARMUP_RUNS = 2
+
+    def __init__(self, path_to_model: Optional[Path] = None, path_to_labels: Optional[Path] = None,
+                 num_threads: int = DEFAULT_NUM_THREADS, warmup_runs: int = WARMUP_RUNS,
+                 has_background_label=True):
         cwd_path = Path(__file__).parent
 
         # path to .tflite file, and .txt file, which contain the model network and labels
-        self.path_to_model = cwd_path / self.MODEL_DIR_NAME / self.GRAPH_FILE_NAME
-        self.path_to_labels = cwd_path / self.MODEL_DIR_NAME / self.LABELS_FILE_NAME
+        if path_to_model is None:
+            path_to_model = cwd_path / self.MODEL_DIR_NAME / self.GRAPH_FILE_NAME
+        if path_to_labels is None:
+            path_to_labels = cwd_path / self.MODEL_DIR_NAME / self.LABELS_FILE_NAME
+        self.path_to_model = Path(path_to_model)
+        self.path_to_labels = Path(path_to_labels)
+        self.num_threads = num_threads
+        self.has_background_label = has_background_label
 
         self.labels = self.parse_labels()
 
         # load the Tensorflow Lite model
-        self.interpreter = Interpreter(model_path=str(self.path_to_model))
+        self.interpreter = self._load_interpreter()
         self.interpreter.allocate_tensors()
 
         # get model details
@@ -48,23 +61,40 @@ class BirdDetectionNetwork:
         self.output_detection_results = None
         self.is_busy = False
 
+        self.warm_up(warmup_runs)
+
+    def _load_interpreter(self):
+        # runtimes that bundle XNNPACK apply it to float ops by default,
+        # but both XNNPACK and the builtin kernels only use more than one core when given a thread count
+        try:
+            return Interpreter(model_path=str(self.path_to_model), num_threads=self.num_threads)
+        except TypeError:
+            # older runtimes don't accept num_threads
+            print("interpreter does not support num_threads, running on a single thread")
+            return Interpreter(model_path=str(self.path_to_model))
+
     def parse_labels(self) -> List[str]:
         # load the label map
         with open(self.path_to_labels, 'r') as f:
             labels = [line.strip() for line in f.readlines()]
-        # first label is '???', which has to be removed.
-        return labels[1:]
+        if self.has_background_label:
+            # first label is '???', which has to be removed.
+            return labels[1:]
+        return labels
 
     def transform_video_frame(self, frame_from_cam):
         # acquire frame and resize to expected shape [1xHxWx3]
         frame = frame_from_cam.copy()
+        return frame, self.prepare_input(frame)
+
+    def prepare_input(self, frame):
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         frame_resized = cv2.resize(frame_rgb, (self.width, self.height))
         input_data = np.expand_dims(frame_resized, axis=0)
         # normalize pixel values if using a floating model (i.e. if model is non-quantized)
         if self.floating_model:
             input_data = (np.float32(input_data) - self.input_mean) / self.input_std
-        return frame, input_data
+        return input_data
 
     def run_image_through_network(self, input_data):
         """
@@ -72,10 +102,31 @@ class BirdDetectionNetwork:
         """
         # perform the actual detection by running the model with the image as input
         self.is_busy = True
+        self.output_detection_results = self.detect(input_data)
+        self.is_busy = False
+
+    def detect(self, input_data):
         self.interpreter.set_tensor(self.network_input[0]['index'], input_data)
         self.interpreter.invoke()
-        self.output_detection_results = self.get_last_detection_results()
-        self.is_busy = False
+        return self.get_last_detection_results()
+
+    def warm_up(self, runs=WARMUP_RUNS):
+        # the first invokes are much slower (allocations, delegate setup), get them out of the way at startup
+        dummy_input = np.zeros(self.network_input[0]['shape'], dtype=self.network_input[0]['dtype'])
+        for _ in range(runs):
+            self.detect(dummy_input)
+
+    def benchmark(self, runs=10) -> float:
+        """
+        returns the median time of a single forward pass, in milliseconds
+        """
+        dummy_input = np.zeros(self.network_input[0]['shape'], dtype=self.network_input[0]['dtype'])
+        times = []
+        for _ in range(runs):
+            start = perf_counter()
+            self.detect(dummy_input)
+            times.append((perf_counter() - start) * 1000)
+        return float(np.median(times))
 
     def get_last_detection_results(self):
         boxes = self.interpreter.get_tensor(self.network_output[0]['index'])[0]
@@ -0,0 +1,160 @@
+import math
+from collections import deque
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+from typing import Deque, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class ClipBuffer:
+    """
+    rolling in-memory buffer of the last few seconds of jpeg encoded frames.
+    it is filled by the capture thread, so the video loop never waits for the encoding.
+    """
+    PRE_ROLL_SEC = 3
+    POST_ROLL_SEC = 3
+    FPS = 8
+    JPEG_QUALITY = 70
+    # frames are scaled down before encoding, clips don't need the full resolution
+    SCALE = 0.5
+    MAX_BUFFER_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, pre_roll_sec=PRE_ROLL_SEC, post_roll_sec=POST_ROLL_SEC, fps=FPS,
+                 max_buffer_bytes=MAX_BUFFER_BYTES):
+        self.pre_roll_sec = pre_roll_sec
+        self.post_roll_sec = post_roll_sec
+        self.fps = fps
+        self.max_buffer_bytes = max_buffer_bytes
+
+        # (monotonic time, jpeg bytes), oldest first
+        self.frames: Deque[Tuple[float, bytes]] = deque()
+        self.total_bytes = 0
+        self.last_frame_time = 0.0
+        self.lock = Lock()
+
+    def add_frame(self, frame):
+        now = monotonic()
+        if now - self.last_frame_time < 1 / self.fps:
+            return
+        self.last_frame_time = now
+
+        jpeg_bytes = self.encode_frame(frame)
+        if jpeg_bytes is not None:
+            self.add_jpeg(now, jpeg_bytes)
+
+    @classmethod
+    def encode_frame(cls, frame) -> Optional[bytes]:
+        if cls.SCALE != 1:
+            frame = cv2.resize(frame, None, fx=cls.SCALE, fy=cls.SCALE, interpolation=cv2.INTER_AREA)
+        is_encoded, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, cls.JPEG_QUALITY])
+        if not is_encoded:
+            return None
+        return jpeg.tobytes()
+
+    def add_jpeg(self, frame_time: float, jpeg_bytes: bytes):
+        """
+        adds a frame that was already encoded with `encode_frame`, `frame_time` is its `time.monotonic()`
+        """
+        with self.lock:
+            self.frames.append((frame_time, jpeg_bytes))
+            self.total_bytes += len(jpeg_bytes)
+
+            # a clip needs both rolls to still be in the buffer when it is assembled
+            oldest_allowed = frame_time - self.pre_roll_sec - self.post_roll_sec
+            while self.frames and (self.frames[0][0] < oldest_allowed or self.total_bytes > self.max_buffer_bytes):
+                _, old_jpeg = self.frames.popleft()
+                self.total_bytes -= len(old_jpeg)
+
+    def frames_between(self, start_time: float, end_time: float) -> List[Tuple[float, bytes]]:
+        with self.lock:
+            return [(frame_time, jpeg) for frame_time, jpeg in self.frames if start_time <= frame_time <= end_time]
+
+
+class ClipRecorder:
+    """
+    assembles a short clip around a detection, from the frames in a `ClipBuffer`
+    """
+    MAX_CLIP_BYTES = 2 * 1024 * 1024
+    FOURCC = 'mp4v'
+    SUFFIX = ".mp4"
+    CONTENT_TYPE = "video/mp4"
+    # clips go in a sub folder of the device's storage folder. the app lists the stills with `listAll()`,
+    # which returns sub folders as prefixes, not items, so clips don't show up as broken images
+    STORAGE_FOLDER = "clips"
+    # if the encoded clip is over the cap, it is re-encoded with half the frames and smaller frames
+    MAX_ENCODE_ATTEMPTS = 4
+    SHRINK_SCALE = 0.75
+
+    def __init__(self, clip_buffer: ClipBuffer, max_clip_bytes=MAX_CLIP_BYTES):
+        self.clip_buffer = clip_buffer
+        self.max_clip_bytes = max_clip_bytes
+
+    def record_clip(self, trigger_time: float, clip_path: Path) -> Optional[Path]:
+        """
+        waits for the post-roll to be captured, and writes the clip to `clip_path`.
+        `trigger_time` is the `time.monotonic()` of the detection. blocks, so run it in a thread.
+        """
+        wait_time = trigger_time + self.clip_buffer.post_roll_sec - monotonic()
+        if wait_time > 0:
+            sleep(wait_time)
+
+        frames = self.clip_buffer.frames_between(trigger_time - self.clip_buffer.pre_roll_sec,
+                                                 trigger_time + self.clip_buffer.post_roll_sec)
+        if len(frames) < 2:
+            print("not enough frames for a clip, skipping it")
+            return None
+
+        frames = self._cap_clip_size(frames)
+        scale = 1.0
+        for _ in range(self.MAX_ENCODE_ATTEMPTS):
+            if not self._write_clip(frames, scale, clip_path):
+                print(f"could not open a {self.FOURCC} video writer, skipping the clip")
+                return None
+
+            clip_size = clip_path.stat().st_size
+            if clip_size <= self.max_clip_bytes:
+                return clip_path
+
+            print(f"clip is {clip_size} bytes, over the {self.max_clip_bytes} limit, shrinking it")
+            # halve the frame rate and shrink the frames
+            if len(frames) > 2:
+                frames = frames[::2]
+            scale *= self.SHRINK_SCALE
+
+        print(f"could not fit the clip into {self.max_clip_bytes} bytes, skipping it")
+        clip_path.unlink()
+        return None
+
+    def _write_clip(self, frames: List[Tuple[float, bytes]], scale: float, clip_path: Path) -> bool:
+        duration = frames[-1][0] - frames[0][0]
+        fps = max(1.0, (len(frames) - 1) / duration) if duration > 0 else self.clip_buffer.fps
+
+        first_frame = self._decode(frames[0][1], scale)
+        height, width = first_frame.shape[:2]
+        writer = cv2.VideoWriter(str(clip_path), cv2.VideoWriter_fourcc(*self.FOURCC), fps, (width, height))
+        if not writer.isOpened():
+            # this opencv build has no encoder for the fourcc
+            return False
+
+        for _, jpeg in frames:
+            writer.write(self._decode(jpeg, scale))
+        writer.release()
+        return clip_path.is_file()
+
+    @staticmethod
+    def _decode(jpeg: bytes, scale: float):
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if scale != 1:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _cap_clip_size(self, frames: List[Tuple[float, bytes]]) -> List[Tuple[float, bytes]]:
+        # drop frames evenly (lowering the frame rate) until the jpegs fit in the clip budget
+        total_bytes = sum(len(jpeg) for _, jpeg in frames)
+        step = math.ceil(total_bytes / self.max_clip_bytes)
+        if step <= 1:
+            return frames
+        return frames[::step]
@@ -0,0 +1,213 @@
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, List, Optional
+
+
+class DetectionHistory:
+    """
+    local store of all detections, with hourly and daily rollups that are updated on every detection.
+    the app gets the rollups and the most recent detections, instead of a list that grows forever.
+    """
+    DB_FILE_PATH = Path(__file__).parent / "detections.db"
+    TIMESTAMP_FORMAT = "%Y-%m-%d-%H-%M-%S"
+    HOUR_FORMAT = "%Y-%m-%d-%H"
+    DAY_FORMAT = "%Y-%m-%d"
+
+    RECENT_COUNT = 50
+    # what is published to the app
+    PUBLISHED_HOURS = 48
+    PUBLISHED_DAYS = 30
+    # what is kept on the device
+    RAW_RETENTION_DAYS = 30
+    HOURLY_RETENTION_DAYS = 7
+    DAILY_RETENTION_DAYS = 365
+
+    # set once the detection list that was in the cloud before this history existed was imported
+    CLOUD_IMPORTED_KEY = "cloud_list_imported"
+
+    def __init__(self, db_file_path=DB_FILE_PATH):
+        # the connection is shared by the writer thread and the upload threads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(str(db_file_path), check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS detections (
+                    id INTEGER PRIMARY KEY,
+                    time REAL NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    confidence INTEGER NOT NULL,
+                    suppressed INTEGER NOT NULL DEFAULT 0,
+                    duplicate INTEGER NOT NULL DEFAULT 0
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS detections_time ON detections (time)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS rollups (
+                    period TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    peak_confidence INTEGER NOT NULL,
+                    PRIMARY KEY (period, bucket)
+                )""")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            last_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM detections").fetchone()[0]
+
+        # ids are handed out before the detection is written, so the video loop can refer to a detection
+        # (e.g. to count duplicates of it) without waiting for the writer thread
+        self.id_lock = Lock()
+        self.next_detection_id = last_id + 1
+
+        # detections queued by the video loop, written by a single writer thread
+        self.write_queue: Queue = Queue()
+        self.writer_thread: Optional[Thread] = None
+
+    def new_detection_id(self) -> int:
+        with self.id_lock:
+            detection_id = self.next_detection_id
+            self.next_detection_id += 1
+        return detection_id
+
+    def add_detection(self, timestamp: str, confidence: int, detection_id: Optional[int] = None,
+                      duplicate_of: Optional[int] = None):
+        """
+        `timestamp` is in `TIMESTAMP_FORMAT`. `duplicate_of` is the id of the detection this one is a duplicate of.
+        duplicates are counted in the rollups and in the suppressed count of that detection, but not listed as recent.
+        """
+        if detection_id is None:
+            detection_id = self.new_detection_id()
+        when = datetime.strptime(timestamp, self.TIMESTAMP_FORMAT)
+        with self.lock, self.connection:
+            self._insert_detection(detection_id, when, timestamp, confidence, 0, duplicate_of is not None)
+            if duplicate_of is not None:
+                self.connection.execute("UPDATE detections SET suppressed = suppressed + 1 WHERE id = ?",
+                                        (duplicate_of,))
+            self._compact(when)
+
+    def queue_detection(self, timestamp: str, confidence: int, detection_id: Optional[int] = None,
+                        duplicate_of: Optional[int] = None):
+        """
+        like `add_detection`, but returns right away, the detection is written by the writer thread.
+        call `flush` before reading, to see it.
+        """
+        if self.writer_thread is None:
+            self.writer_thread = Thread(target=self._write_queued_detections, daemon=True)
+            self.writer_thread.start()
+        self.write_queue.put((timestamp, confidence, detection_id, duplicate_of))
+
+    def _write_queued_detections(self):
+        while True:
+            detection = self.write_queue.get()
+            try:
+                if detection is None:
+                    return
+                self.add_detection(*detection)
+            except (sqlite3.Error, ValueError) as error:
+                # keep the thread alive, or `flush` would wait forever
+                print(f"could not save detection {detection}: {error}")
+            finally:
+                self.write_queue.task_done()
+
+    def flush(self):
+        # waits for the queued detections to be written
+        self.write_queue.join()
+
+    def _insert_detection(self, detection_id: int, when: datetime, timestamp: str, confidence: int,
+                          suppressed_count: int, is_duplicate: bool):
+        self.connection.execute(
+            "INSERT INTO detections (id, time, timestamp, confidence, suppressed, duplicate) VALUES (?, ?, ?, ?, ?, ?)",
+            (detection_id, when.timestamp(), timestamp, confidence, suppressed_count, int(is_duplicate)))
+
+        for period, bucket_format in (("hourly", self.HOUR_FORMAT), ("daily", self.DAY_FORMAT)):
+            self.connection.execute("""
+                INSERT INTO rollups (period, bucket, count, peak_confidence) VALUES (?, ?, 1, ?)
+                ON CONFLICT (period, bucket) DO UPDATE SET
+                    count = count + 1,
+                    peak_confidence = MAX(peak_confidence, excluded.peak_confidence)
+                """, (period, when.strftime(bucket_format), confidence))
+
+    def is_cloud_list_imported(self) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (self.CLOUD_IMPORTED_KEY,)).fetchone()
+        return row is not None
+
+    def import_cloud_list(self, detections: List[Dict]):
+        """
+        one time import of the detection list the owl used to keep in the cloud, in the format the app reads,
+        so the first upload from this history doesn't replace it with only the new detections
+        """
+        imported_count = 0
+        with self.lock, self.connection:
+            for detection in detections:
+                try:
+                    when = datetime.strptime(detection["time"], self.TIMESTAMP_FORMAT)
+                    confidence = int(detection["confidence"])
+                except (TypeError, KeyError, ValueError):
+                    print(f"skipping malformed detection {detection} from the cloud")
+                    continue
+                self._insert_detection(self.new_detection_id(), when, detection["time"], confidence,
+                                       int(detection.get("suppressed", 0)), is_duplicate=False)
+                imported_count += 1
+
+            self._compact(datetime.now())
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                    (self.CLOUD_IMPORTED_KEY, datetime.now().strftime(self.TIMESTAMP_FORMAT)))
+        print(f"imported {imported_count} detections from the cloud")
+
+    def _compact(self, now: datetime):
+        # buckets are zero padded, so comparing them as strings compares them as dates
+        self.connection.execute("DELETE FROM detections WHERE time < ?",
+                                ((now - timedelta(days=self.RAW_RETENTION_DAYS)).timestamp(),))
+        self.connection.execute("DELETE FROM rollups WHERE period = 'hourly' AND bucket < ?",
+                                ((now - timedelta(days=self.HOURLY_RETENTION_DAYS)).strftime(self.HOUR_FORMAT),))
+        self.connection.execute("DELETE FROM rollups WHERE period = 'daily' AND bucket < ?",
+                                ((now - timedelta(days=self.DAILY_RETENTION_DAYS)).strftime(self.DAY_FORMAT),))
+
+    def recent_detections(self, count=RECENT_COUNT) -> List[Dict]:
+        """
+        the newest reported detections, oldest first, in the format the app reads
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT timestamp, confidence, suppressed FROM detections WHERE duplicate = 0 "
+                "ORDER BY time DESC, id DESC LIMIT ?", (count,)).fetchall()
+
+        detections = []
+        for row in reversed(rows):
+            detection = {"time": row["timestamp"], "confidence": row["confidence"]}
+            if row["suppressed"]:
+                detection["suppressed"] = row["suppressed"]
+            detections.append(detection)
+        return detections
+
+    def rollups(self, now=None) -> Dict:
+        if now is None:
+            now = datetime.now()
+
+        with self.lock:
+            hourly = self.connection.execute(
+                "SELECT bucket, count, peak_confidence FROM rollups WHERE period = 'hourly' AND bucket >= ?",
+                ((now - timedelta(hours=self.PUBLISHED_HOURS)).strftime(self.HOUR_FORMAT),)).fetchall()
+            daily = self.connection.execute(
+                "SELECT bucket, count, peak_confidence FROM rollups WHERE period = 'daily' AND bucket >= ?",
+                ((now - timedelta(days=self.PUBLISHED_DAYS)).strftime(self.DAY_FORMAT),)).fetchall()
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM rollups WHERE period = 'daily'").fetchone()[0]
+
+        return {
+            "hourly": {row["bucket"]: {"count": row["count"], "peak": row["peak_confidence"]} for row in hourly},
+            "daily": {row["bucket"]: {"count": row["count"], "peak": row["peak_confidence"]} for row in daily},
+            "total": total,
+            "updated": now.strftime(self.TIMESTAMP_FORMAT),
+        }
+
+    def close(self):
+        if self.writer_thread is not None:
+            self.write_queue.put(None)
+            self.writer_thread.join()
+
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,70 @@
+from datetime import datetime
+from typing import Callable, List, Optional
+
+
+class DetectionTrigger:
+    """
+    decides when network results count as a bird detection that should set off the owl.
+    shared by the live owl and the offline footage evaluation, so both behave the same.
+    """
+    MIN_BIRD_CONFIDENCE = 0.4
+    BIRD_LABEL = "bird"
+    MIN_SEC_BETWEEN_DETECTIONS = 5
+
+    def __init__(self, get_label: Callable = str, min_bird_confidence=MIN_BIRD_CONFIDENCE,
+                 min_sec_between_detections=MIN_SEC_BETWEEN_DETECTIONS):
+        self.get_label = get_label
+        self.min_bird_confidence = min_bird_confidence
+        self.min_sec_between_detections = min_sec_between_detections
+
+        self.bird_detection_scores: List = []
+        # [ymin, xmin, ymax, xmax] of the best bird in the last results, None if there was no bird
+        self.last_bird_box = None
+        self.last_detection_time: Optional[datetime] = None
+
+    def save_detection_score(self, detection_results):
+        boxes, classes, scores = detection_results
+
+        best_bird_score = 0
+        best_bird_box = None
+        for detection_id in range(len(scores)):
+            curr_confidence = scores[detection_id]
+            curr_label = self.get_label(classes[detection_id])
+
+            if curr_label == self.BIRD_LABEL and curr_confidence > best_bird_score:
+                best_bird_score = curr_confidence
+                best_bird_box = boxes[detection_id]
+
+        self.bird_detection_scores.append(best_bird_score)
+        self.last_bird_box = best_bird_box
+
+    def is_bird_high_confidence(self, num_scores=1):
+        # look at the previous `num_scores` scores, and based on their average, decide if a bird was detected
+        if len(self.bird_detection_scores) > num_scores:
+            if sum(self.bird_detection_scores[-num_scores:]) / num_scores > self.min_bird_confidence:
+                return True
+
+        return False
+
+    def is_passed_time_since_last_detection(self, now: datetime):
+        if self.last_detection_time is None:
+            return True
+
+        delta = (now - self.last_detection_time).seconds
+        enough_time_passed = delta > self.min_sec_between_detections
+        return enough_time_passed
+
+    def update(self, detection_results, now: datetime) -> bool:
+        """
+        saves the score of a finished detection, and returns whether the owl should be triggered
+        """
+        self.save_detection_score(detection_results)
+        if self.is_bird_high_confidence() and self.is_passed_time_since_last_detection(now):
+            self.last_detection_time = now
+            return True
+
+        return False
+
+    @property
+    def last_score(self):
+        return self.bird_detection_scores[-1]
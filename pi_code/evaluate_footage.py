@@ -0,0 +1,241 @@
+"""
+runs the bird detection network over recorded footage, to tune thresholds without watching live birds.
+
+usage:
+python -m pi_code.evaluate_footage videos/roof.mp4 images/ --labels labels.csv --out detections.csv
+
+sources are video files, or folders of images (sorted by name, one frame per image).
+the optional labels csv has the columns `source,frame,bird`, where `source` is the file/folder name
+and `bird` is 1 if a bird is visible in that frame.
+"""
+import argparse
+import csv
+import os
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import cv2
+
+from pi_code.bird_detection_network import BirdDetectionNetwork
+from pi_code.detection_trigger import DetectionTrigger
+from pi_code.model_registry import ModelRegistry
+from pi_code.tiled_detection import TiledDetector
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp"}
+
+
+class Chunk(NamedTuple):
+    source: str
+    start: int
+    stop: Optional[int]
+    stride: int
+    fps: float
+
+
+class FrameResult(NamedTuple):
+    source: str
+    frame: int
+    seconds: float
+    # (box, label, score) of every detection above the display threshold
+    detections: List[Tuple[List[float], str, float]]
+    # raw network results, with label names instead of class ids
+    results: Tuple
+
+
+# every worker process loads its own interpreter once
+_worker_network: Optional[BirdDetectionNetwork] = None
+_worker_tiled_detector: Optional[TiledDetector] = None
+
+
+def _init_worker(model_name: Optional[str], num_threads: int, is_tiled: bool):
+    global _worker_network, _worker_tiled_detector
+    _worker_network = ModelRegistry(num_threads=num_threads).load_network(model_name)
+    if is_tiled:
+        _worker_tiled_detector = TiledDetector(_worker_network)
+
+
+def _list_images(folder: Path) -> List[Path]:
+    return sorted(path for path in folder.iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def _read_chunk_frames(chunk: Chunk) -> Iterator[Tuple[int, object]]:
+    # the stride is counted from the first frame of the source, so chunk boundaries don't shift the sampling
+    source = Path(chunk.source)
+    if source.is_dir():
+        images = _list_images(source)
+        first_index = -(-chunk.start // chunk.stride) * chunk.stride
+        for frame_index in range(first_index, min(chunk.stop, len(images)), chunk.stride):
+            yield frame_index, cv2.imread(str(images[frame_index]))
+        return
+
+    capture = cv2.VideoCapture(str(source))
+    capture.set(cv2.CAP_PROP_POS_FRAMES, chunk.start)
+    frame_index = chunk.start
+    while chunk.stop is None or frame_index < chunk.stop:
+        grabbed, frame = capture.read()
+        if not grabbed:
+            break
+        if frame_index % chunk.stride == 0:
+            yield frame_index, frame
+        frame_index += 1
+    capture.release()
+
+
+def _process_chunk(args: Tuple[Chunk, float]) -> List[FrameResult]:
+    chunk, threshold = args
+    network = _worker_network
+    if _worker_tiled_detector is not None:
+        # chunks reach the workers in any order, so every chunk starts with a fresh schedule, like the owl at startup
+        _worker_tiled_detector.reset()
+
+    results = []
+    for frame_index, frame in _read_chunk_frames(chunk):
+        if frame is None:
+            print(f"could not read frame {frame_index} of {chunk.source}, skipping it")
+            continue
+
+        if _worker_tiled_detector is not None:
+            boxes, classes, scores = _worker_tiled_detector.detect_frame(frame)
+        else:
+            boxes, classes, scores = network.detect(network.prepare_input(frame))
+        labels = [network.get_label(class_id) for class_id in classes]
+
+        detections = [([float(coord) for coord in boxes[i]], labels[i], float(scores[i]))
+                      for i in range(len(scores)) if threshold < scores[i] <= 1.0]
+        results.append(FrameResult(source=chunk.source, frame=frame_index, seconds=frame_index / chunk.fps,
+                                   detections=detections, results=(boxes, labels, scores)))
+    return results
+
+
+def _split_into_chunks(sources: List[str], chunk_size: int, stride: int, image_fps: float) -> Iterator[Chunk]:
+    for source in sources:
+        source_path = Path(source)
+        if source_path.is_dir():
+            frame_count = len(_list_images(source_path))
+            fps = image_fps
+            if frame_count == 0:
+                print(f"no images in {source}, skipping it")
+                continue
+        else:
+            capture = cv2.VideoCapture(source)
+            if not capture.isOpened():
+                print(f"could not open {source}, skipping it")
+                continue
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            fps = capture.get(cv2.CAP_PROP_FPS) or image_fps
+            capture.release()
+
+        if frame_count <= 0:
+            # some containers don't know their length, read them in one go
+            yield Chunk(source=source, start=0, stop=None, stride=stride, fps=fps)
+            continue
+
+        for start in range(0, frame_count, chunk_size):
+            yield Chunk(source=source, start=start, stop=min(start + chunk_size, frame_count), stride=stride, fps=fps)
+
+
+def _read_ground_truth(labels_path: Path) -> Dict[Tuple[str, int], bool]:
+    ground_truth = {}
+    with open(labels_path, newline='') as f:
+        for row in csv.DictReader(f):
+            ground_truth[(row["source"], int(row["frame"]))] = bool(int(row["bird"]))
+    return ground_truth
+
+
+def _get_input_arguments():
+    parser = argparse.ArgumentParser(description="run the bird detector over recorded footage")
+    parser.add_argument('sources', nargs='+', help='video files, or folders of images')
+    parser.add_argument('--labels', help='ground truth csv with the columns source,frame,bird', default=None)
+    parser.add_argument('--out', help='per-frame detections csv', default='detections.csv')
+    parser.add_argument('--threshold', help='minimum confidence threshold for reported detections', default=0.5)
+    parser.add_argument('--min-bird-confidence', help='minimum bird confidence that triggers the owl',
+                        default=DetectionTrigger.MIN_BIRD_CONFIDENCE)
+    parser.add_argument('--min-sec-between-detections', help='minimum seconds between two triggers',
+                        default=DetectionTrigger.MIN_SEC_BETWEEN_DETECTIONS)
+    parser.add_argument('--model', help='name of the tflite model to use', default=None)
+    parser.add_argument('--workers', help='number of worker processes', default=os.cpu_count() or 1)
+    parser.add_argument('--threads', help='interpreter threads per worker', default=1)
+    parser.add_argument('--chunk', help='frames per work item', default=256)
+    parser.add_argument('--stride', help='only evaluate every n-th frame', default=1)
+    parser.add_argument('--image-fps', help='frame rate assumed for image folders', default=10)
+    parser.add_argument('--tiles', help='also run the network on tiles of the frame, like the owl with --tiles=1',
+                        default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = _get_input_arguments()
+    threshold = float(args.threshold)
+    ground_truth = _read_ground_truth(Path(args.labels)) if args.labels else None
+
+    # resolve the model once, so the workers don't all benchmark at the same time
+    model_name = args.model
+    if model_name is None:
+        registry = ModelRegistry()
+        model_name = registry.cached_choice() or registry.available_models()[0].name
+
+    chunks = _split_into_chunks(args.sources, int(args.chunk), int(args.stride), float(args.image_fps))
+    tasks = ((chunk, threshold) for chunk in chunks)
+
+    true_positives = false_positives = false_negatives = 0
+    frames = 0
+    footage_seconds: Dict[str, float] = {}
+    triggers: Dict[str, int] = {}
+    trigger: Optional[DetectionTrigger] = None
+    start_time = datetime.now()
+    wall_start = perf_counter()
+
+    with open(args.out, 'w', newline='') as out_file, \
+            Pool(int(args.workers), initializer=_init_worker, initargs=(model_name, int(args.threads), bool(int(args.tiles)))) as pool:
+        writer = csv.writer(out_file)
+        writer.writerow(["source", "frame", "seconds", "label", "score", "ymin", "xmin", "ymax", "xmax", "triggered"])
+
+        # imap keeps the order of the chunks, so the trigger sees the frames in order
+        for chunk_results in pool.imap(_process_chunk, tasks):
+            for result in chunk_results:
+                source_name = Path(result.source).name
+                if source_name not in triggers:
+                    # every source is a separate recording
+                    trigger = DetectionTrigger(min_bird_confidence=float(args.min_bird_confidence),
+                                               min_sec_between_detections=float(args.min_sec_between_detections))
+                    triggers[source_name] = 0
+
+                frames += 1
+                footage_seconds[source_name] = result.seconds
+                triggered = trigger.update(result.results, start_time + timedelta(seconds=result.seconds))
+                triggers[source_name] += int(triggered)
+
+                for box, label, score in result.detections:
+                    writer.writerow([source_name, result.frame, f"{result.seconds:.2f}", label, f"{score:.3f}",
+                                     *[f"{coord:.4f}" for coord in box], int(triggered)])
+                if triggered and not result.detections:
+                    writer.writerow([source_name, result.frame, f"{result.seconds:.2f}", "", "", "", "", "", "", 1])
+
+                if ground_truth is not None and (source_name, result.frame) in ground_truth:
+                    predicted = trigger.last_score > trigger.min_bird_confidence
+                    actual = ground_truth[(source_name, result.frame)]
+                    true_positives += int(predicted and actual)
+                    false_positives += int(predicted and not actual)
+                    false_negatives += int(actual and not predicted)
+
+    wall_seconds = perf_counter() - wall_start
+    total_footage_seconds = sum(footage_seconds.values())
+    print(f"evaluated {frames} frames in {wall_seconds:.1f} seconds ({frames / max(wall_seconds, 1e-6):.1f} fps), "
+          f"{total_footage_seconds / max(wall_seconds, 1e-6):.1f}x real time")
+    for source_name, trigger_count in triggers.items():
+        print(f"{source_name}: {trigger_count} triggers")
+
+    if ground_truth is not None:
+        precision = true_positives / max(true_positives + false_positives, 1)
+        recall = true_positives / max(true_positives + false_negatives, 1)
+        print(f"precision={precision:.3f} recall={recall:.3f} "
+              f"(tp={true_positives} fp={false_positives} fn={false_negatives})")
+
+    print(f"detections saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+load test of the firebase schema the owls use, with many simulated owls against a local stand-in of
+the realtime database and storage.
+
+usage:
+python -m pi_code.fleet_simulator --owls 1,10,50,100 --duration 30 --latency-ms 80
+
+every simulated owl runs the real `OwlCloud` command, settings and detection upload code of the owl,
+without a camera, network or hardware. the owls are coroutines, and their blocking firebase calls
+run in a shared thread pool, so hundreds of owls fit in one process.
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Dict, List
+
+from pi_code.detection_history import DetectionHistory
+from pi_code.owl_cloud import OwlCloud
+
+
+def _split_path(path: str) -> List[str]:
+    return [part for part in path.split("/") if part]
+
+
+def _size(value) -> int:
+    return len(json.dumps(value)) if value is not None else 0
+
+
+class MockRealtimeDatabase:
+    """
+    in-process stand-in for the firebase realtime database, with injected latency and I/O accounting
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.data: Dict[str, Any] = {}
+        self.lock = Lock()
+        self.push_counter = 0
+
+        self.reads = 0
+        self.writes = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        # path of every command the simulated app sent, and when it was sent
+        self.command_sent_times: Dict[str, float] = {}
+        self.command_latencies: List[float] = []
+
+    def reference(self, path="/") -> "MockReference":
+        return MockReference(self, _split_path(path))
+
+    def _network_delay(self):
+        if self.latency_ms > 0:
+            sleep(random.uniform(0.5, 1.5) * self.latency_ms / 1000)
+
+    def get(self, parts: List[str]):
+        self._network_delay()
+        with self.lock:
+            node = self.data
+            for part in parts:
+                if not isinstance(node, dict) or part not in node:
+                    node = None
+                    break
+                node = node[part]
+            # copy, like a real download
+            value = json.loads(json.dumps(node)) if node is not None else None
+            self.reads += 1
+            self.bytes_read += _size(value)
+        return value
+
+    def set(self, parts: List[str], value):
+        self._network_delay()
+        with self.lock:
+            node = self.data
+            for part in parts[:-1]:
+                if not isinstance(node.get(part), dict):
+                    node[part] = {}
+                node = node[part]
+            node[parts[-1]] = json.loads(json.dumps(value))
+            self.writes += 1
+            self.bytes_written += _size(value)
+
+            path = "/".join(parts)
+            if path in self.command_sent_times and isinstance(value, dict) and value.get("applied") == "true":
+                self.command_latencies.append(monotonic() - self.command_sent_times.pop(path))
+
+    def next_push_key(self) -> str:
+        with self.lock:
+            self.push_counter += 1
+            # firebase push ids are ordered by time, and so are these
+            return f"-sim{self.push_counter:016d}"
+
+
+class MockReference:
+    def __init__(self, database: MockRealtimeDatabase, parts: List[str]):
+        self.database = database
+        self.parts = parts
+
+    @property
+    def path(self) -> str:
+        return "/" + "/".join(self.parts)
+
+    def child(self, path: str) -> "MockReference":
+        return MockReference(self.database, self.parts + _split_path(path))
+
+    def get(self):
+        return self.database.get(self.parts)
+
+    def set(self, value):
+        self.database.set(self.parts, value)
+
+    def push(self, value=None) -> "MockReference":
+        reference = self.child(self.database.next_push_key())
+        if value is not None:
+            reference.set(value)
+        return reference
+
+
+class MockBucket:
+    """
+    in-process stand-in for the firebase storage bucket
+    """
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.lock = Lock()
+        self.uploads = 0
+        self.bytes_uploaded = 0
+
+    def blob(self, path: str) -> "MockBlob":
+        return MockBlob(self, path)
+
+
+class MockBlob:
+    def __init__(self, bucket: MockBucket, path: str):
+        self.bucket = bucket
+        self.path = path
+
+    def upload_from_filename(self, filename, content_type=None):
+        if self.bucket.latency_ms > 0:
+            sleep(random.uniform(0.5, 1.5) * self.bucket.latency_ms / 1000)
+        size = Path(filename).stat().st_size
+        with self.bucket.lock:
+            self.bucket.uploads += 1
+            self.bucket.bytes_uploaded += size
+
+
+class SimulatedSpeaker:
+    def __init__(self):
+        self.muted = True
+        self.owl_screech = "owl_screech.mp3"
+
+    def random_sound(self):
+        return self.owl_screech
+
+    def play_sound(self, sound_file_name):
+        pass
+
+    def stop_music(self):
+        pass
+
+    def change_volume_setting(self, volume=0.2):
+        pass
+
+
+class SimulatedServos:
+    def __init__(self):
+        self.fixed_head = False
+        self.stop_flaps = False
+
+    def set_head_degree(self, degree):
+        pass
+
+    def flap_wings(self):
+        pass
+
+
+class SimulatedImage:
+    """
+    stands in for the PIL image of a detection, with a fixed jpeg size
+    """
+
+    def __init__(self, size_bytes: int):
+        self.content = bytes(size_bytes)
+
+    def save(self, path):
+        Path(path).write_bytes(self.content)
+
+
+class SimulatedOwl(OwlCloud):
+    """
+    an owl without a camera, network or hardware, talking to the mock firebase.
+    only sets up what the command, settings and detection upload code paths use.
+    """
+
+    def __init__(self, device_id: int, user_id: str, database: MockRealtimeDatabase, bucket: MockBucket,
+                 images_dir: Path):
+        self._init_cloud_state()
+        self.DEVICE_ID = device_id
+        self.images_dir = images_dir
+
+        self.mp3 = SimulatedSpeaker()
+        self.servo_motors = SimulatedServos()
+
+        self.settings_db = database.reference(f"/owls/{device_id}/settings")
+        self.detections_db = database.reference(f"/users/{user_id}/detections/device/{device_id}")
+        self.detection_rollups_db = database.reference(f"/users/{user_id}/detections/rollups/{device_id}")
+        self.commands_path = f"/users/{user_id}/commands/device/{device_id}"
+        self.commands_db = database.reference(self.commands_path)
+        self.detections_storage = bucket
+
+        self.history = DetectionHistory(":memory:")
+
+    def simulate_detection(self, image: SimulatedImage):
+        # the cloud side of `_bird_detected_action`, through the same history queue and upload thread gating.
+        # the push notification and the snapshot deduplication are left out
+        timestamp = self._get_timestamp()
+        confidence = random.randint(40, 99)
+        self.history.queue_detection(timestamp, confidence)
+        self.has_unpublished_detections = True
+
+        full_blob_path = f"{self.DEVICE_ID}/{timestamp}_{confidence}.jpg"
+        full_image_path = str(self.images_dir / f"{self.DEVICE_ID}.jpg")
+        self._upload_frame_image(image, full_blob_path, full_image_path)
+        self._save_detection_metadata_action()
+
+
+class FleetStats:
+    def __init__(self):
+        self.detections = 0
+        self.commands_sent = 0
+        # size of the data the owls meant to write, to measure write amplification against
+        self.logical_bytes = 0
+        # seconds blocking calls waited for a free thread, so the pool size doesn't pass for database latency
+        self.queue_waits: List[float] = []
+
+
+async def _run_blocking(loop, executor, stats: FleetStats, func, *args):
+    submit_time = monotonic()
+
+    def timed_call():
+        stats.queue_waits.append(monotonic() - submit_time)
+        return func(*args)
+
+    return await loop.run_in_executor(executor, timed_call)
+
+
+async def _poll_forever(loop, executor, poll, stop_time: float, poll_interval: float, stats: FleetStats):
+    while loop.time() < stop_time:
+        await _run_blocking(loop, executor, stats, poll)
+        await asyncio.sleep(poll_interval)
+
+
+async def _publish_pending_forever(loop, owl: SimulatedOwl, stop_time: float):
+    # the video loop checks for detections that are waiting to be published on every frame
+    while loop.time() < stop_time:
+        owl._publish_pending_detections()
+        await asyncio.sleep(0.1)
+
+
+async def _detect_forever(loop, executor, owl: SimulatedOwl, image: SimulatedImage, stop_time: float,
+                          mean_interval: float, stats: FleetStats):
+    while True:
+        delay = random.expovariate(1 / mean_interval)
+        if loop.time() + delay >= stop_time:
+            # don't keep the fleet running past the duration, it would water down the rates
+            return
+        await asyncio.sleep(delay)
+        await _run_blocking(loop, executor, stats, owl.simulate_detection, image)
+        stats.detections += 1
+        stats.logical_bytes += _size({"time": owl._get_timestamp(), "confidence": 99})
+
+
+async def _send_commands_forever(loop, executor, database: MockRealtimeDatabase, owl: SimulatedOwl,
+                                 stop_time: float, mean_interval: float, stats: FleetStats):
+    # the app side: a user pressing "Trigger Alarm" every now and then
+    commands_db = database.reference(owl.commands_path)
+    while True:
+        delay = random.expovariate(1 / mean_interval)
+        if loop.time() + delay >= stop_time:
+            return
+        await asyncio.sleep(delay)
+
+        command = {"command": "Trigger Alarm", "applied": "false", "date": datetime.now().isoformat()}
+        command_db = commands_db.child(database.next_push_key())
+        database.command_sent_times[command_db.path.strip("/")] = monotonic()
+        await _run_blocking(loop, executor, stats, command_db.set, command)
+        stats.commands_sent += 1
+        stats.logical_bytes += _size(dict(command, applied="true"))
+
+
+def _create_fleet(database: MockRealtimeDatabase, bucket: MockBucket, owl_count: int, owls_per_user: int,
+                  images_dir: Path) -> List[SimulatedOwl]:
+    owls = []
+    for device_id in range(owl_count):
+        user_id = f"user{device_id // owls_per_user}"
+        database.reference(f"/owls/{device_id}/settings").set({
+            "assicatedUid": user_id, "mute": True, "notify": True, "fixedHead": False, "volume": 50, "angle": 90,
+        })
+        owls.append(SimulatedOwl(device_id, user_id, database, bucket, images_dir))
+    return owls
+
+
+async def _run_fleet(args, owl_count: int, images_dir: Path) -> Dict[str, float]:
+    database = MockRealtimeDatabase(latency_ms=float(args.latency_ms))
+    bucket = MockBucket(latency_ms=float(args.latency_ms))
+    owls = _create_fleet(database, bucket, owl_count, int(args.owls_per_user), images_dir)
+    image = SimulatedImage(int(args.image_kb) * 1024)
+    stats = FleetStats()
+
+    # the setup writes are not part of the measurement
+    database.reads = database.writes = database.bytes_read = database.bytes_written = 0
+
+    loop = asyncio.get_running_loop()
+    # two pollers, a detector and the app per owl may all be blocked on the database at the same time,
+    # so by default every one of them gets a thread, and calls never wait for one
+    max_threads = owl_count * 4 if args.max_threads is None else int(args.max_threads)
+    executor = ThreadPoolExecutor(max_workers=max_threads)
+    start_time = loop.time()
+    stop_time = start_time + float(args.duration)
+
+    tasks = []
+    for owl in owls:
+        poll_interval = float(args.poll_interval)
+        tasks.append(_poll_forever(loop, executor, owl.check_realtime_commands, stop_time, poll_interval, stats))
+        tasks.append(_poll_forever(loop, executor, owl.check_settings_changed, stop_time, poll_interval, stats))
+        tasks.append(_detect_forever(loop, executor, owl, image, stop_time, float(args.detection_interval), stats))
+        tasks.append(_publish_pending_forever(loop, owl, stop_time))
+        tasks.append(_send_commands_forever(loop, executor, database, owl, stop_time,
+                                            float(args.command_interval), stats))
+    await asyncio.gather(*tasks)
+    # metadata uploads run in the owls' own threads, like on the owl
+    for owl in owls:
+        if owl.upload_metadata_thread is not None:
+            owl.upload_metadata_thread.join()
+    elapsed = loop.time() - start_time
+    executor.shutdown()
+
+    latencies = sorted(database.command_latencies)
+    queue_waits = sorted(stats.queue_waits)
+    return {
+        "owls": owl_count,
+        "commands": stats.commands_sent,
+        "applied": len(latencies),
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "queue_p95_ms": _percentile(queue_waits, 95) * 1000,
+        "ops_per_sec": (database.reads + database.writes) / elapsed,
+        "read_kb_per_sec": database.bytes_read / 1024 / elapsed,
+        "write_kb_per_sec": database.bytes_written / 1024 / elapsed,
+        "detections_per_sec": stats.detections / elapsed,
+        "write_amplification": database.bytes_written / max(stats.logical_bytes, 1),
+        "storage_kb_per_sec": bucket.bytes_uploaded / 1024 / elapsed,
+    }
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _print_report(results: List[Dict[str, float]]):
+    columns = ["owls", "commands", "applied", "p50_ms", "p95_ms", "queue_p95_ms", "ops_per_sec", "read_kb_per_sec",
+               "write_kb_per_sec", "detections_per_sec", "write_amplification", "storage_kb_per_sec"]
+    print("  ".join(columns))
+    for result in results:
+        print("  ".join(f"{result[column]:>{len(column)}.1f}" if isinstance(result[column], float)
+                        else f"{result[column]:>{len(column)}}" for column in columns))
+
+
+def _get_input_arguments():
+    parser = argparse.ArgumentParser(description="load test the owl firebase schema with simulated owls")
+    parser.add_argument('--owls', help='comma separated fleet sizes to simulate', default='1,10,50')
+    parser.add_argument('--owls-per-user', help='owls registered to every user account', default=4)
+    parser.add_argument('--duration', help='seconds to run every fleet size', default=30)
+    parser.add_argument('--latency-ms', help='mean injected latency of every database/storage call', default=80)
+    parser.add_argument('--poll-interval', help='seconds between command/settings polls of an owl, '
+                                                'the default 0 polls back to back like the video loop', default=0)
+    parser.add_argument('--detection-interval', help='mean seconds between detections of an owl', default=10)
+    parser.add_argument('--command-interval', help='mean seconds between app commands to an owl', default=15)
+    parser.add_argument('--image-kb', help='size of an uploaded detection image', default=120)
+    parser.add_argument('--max-threads', help='size of the thread pool the blocking calls run in '
+                                              '(default: 4 per owl)', default=None)
+    parser.add_argument('--verbose', help='show what the simulated owls print', default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = _get_input_arguments()
+    results = []
+    with tempfile.TemporaryDirectory() as images_dir:
+        for owl_count in [int(count) for count in args.owls.split(",")]:
+            print(f"simulating {owl_count} owls for {args.duration} seconds...")
+            # the owls print every command and upload, which drowns the report
+            quiet = nullcontext() if bool(int(args.verbose)) else redirect_stdout(io.StringIO())
+            with quiet:
+                results.append(asyncio.run(_run_fleet(args, owl_count, Path(images_dir))))
+    _print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import json
+import platform
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from pi_code.bird_detection_network import BirdDetectionNetwork
+
+
+class ModelSpec(NamedTuple):
+    name: str
+    model_dir: str
+    graph_file: str = "detect.tflite"
+    labels_file: str = "labelmap.txt"
+    # relative detection quality of the model (e.g. its COCO mAP), used when picking a model
+    accuracy: float = 0.0
+    # whether the label map starts with a '???' background line, which the network does not output.
+    # a bird-only label map that is just "bird" has none
+    has_background_label: bool = True
+
+
+class ModelRegistry:
+    """
+    holds the tflite variants we ship, and picks the one a device should run.
+    to add a variant (float, quantized, other input size, bird-only labels), put its folder next to
+    `Sample_TFLite_model` and add a `ModelSpec` to `MODELS`. entries whose files are missing are skipped.
+    for now we only ship the sample model, so there is nothing to benchmark until a second variant is added.
+    """
+    CWD = Path(__file__).parent
+
+    MODELS = [
+        ModelSpec(name="ssd_mobilenet_v1_coco_quant", model_dir="Sample_TFLite_model", accuracy=0.18),
+    ]
+
+    # the benchmark result of every device model is cached here, so we only benchmark once per pi model
+    CHOICE_CACHE_FILE_PATH = CWD / "model_choice.json"
+    DEVICE_MODEL_FILE_PATH = Path("/proc/device-tree/model")
+    BENCHMARK_RUNS = 10
+
+    # budget for picking a model
+    MAX_LATENCY_MS = 500
+    MIN_ACCURACY = 0.0
+
+    def __init__(self, num_threads=BirdDetectionNetwork.DEFAULT_NUM_THREADS,
+                 max_latency_ms=MAX_LATENCY_MS, min_accuracy=MIN_ACCURACY):
+        self.num_threads = num_threads
+        self.max_latency_ms = max_latency_ms
+        self.min_accuracy = min_accuracy
+
+    def model_path(self, spec: ModelSpec) -> Path:
+        return self.CWD / spec.model_dir / spec.graph_file
+
+    def labels_path(self, spec: ModelSpec) -> Path:
+        return self.CWD / spec.model_dir / spec.labels_file
+
+    def available_models(self) -> List[ModelSpec]:
+        available = []
+        for spec in self.MODELS:
+            if self.model_path(spec).is_file() and self.labels_path(spec).is_file():
+                available.append(spec)
+            else:
+                print(f"model {spec.name} was not found, skipping it")
+        return available
+
+    def get(self, name: str) -> ModelSpec:
+        for spec in self.available_models():
+            if spec.name == name:
+                return spec
+        raise ValueError(f"unknown model {name}")
+
+    def build_network(self, spec: ModelSpec) -> BirdDetectionNetwork:
+        return BirdDetectionNetwork(path_to_model=self.model_path(spec), path_to_labels=self.labels_path(spec),
+                                    num_threads=self.num_threads, has_background_label=spec.has_background_label)
+
+    def load_network(self, name: Optional[str] = None, force_benchmark=False) -> BirdDetectionNetwork:
+        """
+        loads `name` if given, otherwise the best model for this device.
+        the best model is read from the cache, unless there is none or `force_benchmark` is set.
+        """
+        if name is not None:
+            return self.build_network(self.get(name))
+
+        candidates = self.available_models()
+        if not candidates:
+            raise IOError("no tflite model was found")
+
+        if len(candidates) == 1:
+            return self.build_network(candidates[0])
+
+        if not force_benchmark:
+            cached_name = self.cached_choice(candidates)
+            cached = [spec for spec in candidates if spec.name == cached_name]
+            if cached:
+                print(f"using model {cached_name}, picked by a previous benchmark")
+                return self.build_network(cached[0])
+
+        return self.pick_best_network(candidates)
+
+    def pick_best_network(self, candidates: List[ModelSpec]) -> BirdDetectionNetwork:
+        """
+        benchmarks every candidate on this device, and returns the fastest one that meets the budget.
+        if none of them do, the fastest one is returned.
+        """
+        # only the best network so far is kept alive, so every variant doesn't hold an interpreter at once
+        best = None
+        # the fastest network overall, in case none of them meet the budget
+        fastest = None
+        for spec in candidates:
+            network = self.build_network(spec)
+            latency_ms = network.benchmark(self.BENCHMARK_RUNS)
+            print(f"model {spec.name}: {latency_ms:.1f}ms per frame")
+
+            result = (latency_ms, spec, network)
+            if latency_ms <= self.max_latency_ms and spec.accuracy >= self.min_accuracy:
+                if best is None or latency_ms < best[0]:
+                    best = result
+                fastest = None
+            elif best is None and (fastest is None or latency_ms < fastest[0]):
+                fastest = result
+            # drop our references, so a network that was not kept is freed before the next one is built
+            del network, result
+
+        if best is None:
+            print(f"no model meets the budget of {self.max_latency_ms}ms and {self.min_accuracy} accuracy, "
+                  f"using the fastest one")
+            best = fastest
+
+        latency_ms, spec, network = best
+        print(f"picked model {spec.name}")
+        self._write_cached_choice(candidates, spec.name, latency_ms)
+        return network
+
+    @classmethod
+    def device_model(cls) -> str:
+        # e.g. "Raspberry Pi 4 Model B Rev 1.4"
+        if cls.DEVICE_MODEL_FILE_PATH.is_file():
+            return cls.DEVICE_MODEL_FILE_PATH.read_text().strip("\0\n ")
+        return platform.machine()
+
+    def _read_cache(self) -> dict:
+        if not self.CHOICE_CACHE_FILE_PATH.is_file():
+            return {}
+        try:
+            return json.loads(self.CHOICE_CACHE_FILE_PATH.read_text())
+        except ValueError:
+            print(f"{self.CHOICE_CACHE_FILE_PATH} is corrupted, ignoring it")
+            return {}
+
+    def _cache_key(self, candidates: List[ModelSpec]) -> str:
+        # a pick is only valid for the same device, thread count and set of models it was picked from
+        model_names = ",".join(sorted(spec.name for spec in candidates))
+        return f"{self.device_model()}|threads={self.num_threads}|models={model_names}"
+
+    def cached_choice(self, candidates: Optional[List[ModelSpec]] = None) -> Optional[str]:
+        if candidates is None:
+            candidates = self.available_models()
+        choice = self._read_cache().get(self._cache_key(candidates))
+        if choice is None:
+            return None
+        return choice["model"]
+
+    def _write_cached_choice(self, candidates: List[ModelSpec], name: str, latency_ms: float):
+        cache = self._read_cache()
+        cache[self._cache_key(candidates)] = {"model": name, "latency_ms": round(latency_ms, 1)}
+        self.CHOICE_CACHE_FILE_PATH.write_text(json.dumps(cache, indent=2))
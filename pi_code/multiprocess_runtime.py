@@ -0,0 +1,309 @@
+import multiprocessing as mp
+from collections import deque
+from queue import Empty, Full
+from threading import Thread
+from time import monotonic, sleep
+from typing import Any, Deque, Dict, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from pi_code.clip_recorder import ClipBuffer
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory: Any = None
+
+
+class SharedFrameRing:
+    """
+    ring buffer of frames in shared memory, with a single writer process and any number of readers.
+    frames never get pickled, readers copy the newest complete slot straight out of the shared block.
+    """
+
+    def __init__(self, frame_shape: Tuple[int, int, int], slots=4):
+        self.frame_shape = frame_shape
+        self.slots = slots
+        self.frame_bytes = int(np.prod(frame_shape))
+
+        self.memory = shared_memory.SharedMemory(create=True, size=self.frame_bytes * slots)
+        self.memory_name = self.memory.name
+        # sequence number of the frame in every slot (-1 while it is being written), and of the newest frame
+        self.slot_sequences = mp.Array('q', [-1] * slots, lock=False)
+        self.latest_sequence = mp.Value('q', -1, lock=False)
+
+    def __getstate__(self):
+        # child processes attach to the block by name
+        state = self.__dict__.copy()
+        del state["memory"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=self.memory_name)
+
+    def _slot_array(self, slot: int) -> np.ndarray:
+        return np.ndarray(self.frame_shape, dtype=np.uint8, buffer=self.memory.buf,
+                          offset=slot * self.frame_bytes)
+
+    def write(self, frame: np.ndarray):
+        sequence = self.latest_sequence.value + 1
+        slot = sequence % self.slots
+        self.slot_sequences[slot] = -1
+        self._slot_array(slot)[:] = frame
+        self.slot_sequences[slot] = sequence
+        self.latest_sequence.value = sequence
+
+    def read_latest(self) -> Tuple[int, Optional[np.ndarray]]:
+        """
+        returns (sequence number, copy of the newest frame), or (-1, None) before the first frame
+        """
+        while True:
+            sequence = self.latest_sequence.value
+            if sequence < 0:
+                return sequence, None
+
+            slot = sequence % self.slots
+            frame = self._slot_array(slot).copy()
+            # if the writer lapped us while we were copying, the slot holds a newer sequence and we retry
+            if self.slot_sequences[slot] == sequence:
+                return sequence, frame
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class DetectionRecord(NamedTuple):
+    sequence: int
+    seconds: float
+    # (boxes, labels, scores), with label names instead of class ids
+    results: Tuple
+
+
+def _capture_stage(ring: SharedFrameRing, resolution: Tuple[int, int], clip_queue, clip_fps: float, stop_event):
+    # imported here, so only the capture process opens the camera
+    from pi_code.video_stream import VideoStream
+
+    videostream = VideoStream(resolution=resolution)
+    width, height = resolution
+    last_clip_frame_time = 0.0
+    while not stop_event.is_set():
+        grabbed, frame = videostream.stream.read()
+        if not grabbed:
+            continue
+        if frame.shape != ring.frame_shape:
+            # the camera does not support the requested resolution
+            frame = cv2.resize(frame, (width, height))
+        ring.write(frame)
+
+        # clip frames are jpeg encoded here, so the encoding doesn't hold the main process's GIL
+        now = monotonic()
+        if clip_queue is not None and now - last_clip_frame_time >= 1 / clip_fps:
+            last_clip_frame_time = now
+            jpeg_bytes = ClipBuffer.encode_frame(frame)
+            if jpeg_bytes is not None:
+                try:
+                    clip_queue.put_nowait((now, jpeg_bytes))
+                except Full:
+                    pass
+
+    if clip_queue is not None:
+        # don't wait on exit for the main process to drain the last clip frames
+        clip_queue.cancel_join_thread()
+    videostream.stream.release()
+    ring.close()
+
+
+def _inference_stage(ring: SharedFrameRing, detections_queue, model_name: Optional[str], num_threads: int,
+                     is_tiled: bool, stop_event):
+    from pi_code.model_registry import ModelRegistry
+    from pi_code.tiled_detection import TiledDetector
+
+    network = ModelRegistry(num_threads=num_threads).load_network(model_name)
+    tiled_detector = TiledDetector(network) if is_tiled else None
+
+    last_sequence = -1
+    while not stop_event.is_set():
+        sequence, frame = ring.read_latest()
+        if sequence == last_sequence or frame is None:
+            sleep(0.005)
+            continue
+        last_sequence = sequence
+
+        if tiled_detector is not None:
+            boxes, classes, scores = tiled_detector.detect_frame(frame)
+        else:
+            boxes, classes, scores = network.detect(network.prepare_input(frame))
+        labels = [network.get_label(class_id) for class_id in classes]
+
+        record = DetectionRecord(sequence=sequence, seconds=monotonic(), results=(boxes, labels, scores))
+        try:
+            detections_queue.put_nowait(record)
+        except Full:
+            # the main process is behind, it only needs the newest records anyway
+            pass
+
+    ring.close()
+
+
+class MultiprocessRuntime:
+    """
+    runs capture and inference in their own processes, so they don't share the GIL with the main
+    process, which draws the frames and does all the firebase/network I/O.
+    frames go through a `SharedFrameRing`, and only small `DetectionRecord`s and clip jpegs go through queues.
+    has the same `read`/`stop` interface as `VideoStream`.
+
+    the firebase/requests threads deliberately stay in the main process: they spend their time waiting on
+    sockets, which releases the GIL, and they drive the speaker and servos that live in this process.
+    moving them out would mean proxying every command and setting back through another queue.
+    """
+    RING_SLOTS = 4
+    QUEUE_SIZE = 8
+    # a few seconds of clip frames, in case the main process stalls
+    CLIP_QUEUE_SIZE = 32
+    # a stage that crashes more than `MAX_RESTARTS` times within `RESTART_WINDOW_SEC` is given up on
+    MAX_RESTARTS = 5
+    RESTART_WINDOW_SEC = 60 * 60
+    # spawned stages import their modules (and tflite) from scratch before they open the camera
+    FIRST_FRAME_TIMEOUT_SEC = 30
+    JOIN_TIMEOUT_SEC = 3
+
+    # capture, inference and the main process each get a core, inference gets whatever is left
+    DEFAULT_NUM_THREADS = max(1, mp.cpu_count() - 2)
+
+    def __init__(self, resolution=(640, 480), model_name: Optional[str] = None, num_threads=DEFAULT_NUM_THREADS,
+                 is_tiled=False, clip_buffer: Optional[ClipBuffer] = None):
+        if shared_memory is None:
+            raise RuntimeError("the multiprocess runtime needs python 3.8 or newer")
+
+        # stages are restarted from the main loop while the upload, servo and sound threads are running.
+        # forking a process with running threads can deadlock the child on a lock one of them held,
+        # so the stages are spawned, and the ring is passed to them by name
+        self.context = mp.get_context("spawn")
+
+        width, height = resolution
+        self.ring = SharedFrameRing((height, width, 3), slots=self.RING_SLOTS)
+        self.detections_queue = self.context.Queue(maxsize=self.QUEUE_SIZE)
+        self.stop_event = self.context.Event()
+
+        # detection clips are fed from the capture process, since there is no capture thread in this process
+        self.clip_buffer = clip_buffer
+        self.clip_queue = self.context.Queue(maxsize=self.CLIP_QUEUE_SIZE) if clip_buffer is not None else None
+        self.clip_thread: Optional[Thread] = None
+        clip_fps = clip_buffer.fps if clip_buffer is not None else 0
+
+        self.stage_targets: Dict[str, tuple] = {
+            "capture": (_capture_stage, (self.ring, resolution, self.clip_queue, clip_fps, self.stop_event)),
+            "inference": (_inference_stage, (self.ring, self.detections_queue, model_name, num_threads,
+                                             is_tiled, self.stop_event)),
+        }
+        self.stages: Dict[str, Any] = {}
+        # monotonic times of the recent restarts of every stage
+        self.restart_times: Dict[str, Deque[float]] = {name: deque() for name in self.stage_targets}
+
+        self.frame = None
+        self.stopped = False
+        self.is_closed = False
+
+    def start(self):
+        for name in self.stage_targets:
+            self._start_stage(name)
+
+        start_time = monotonic()
+        while self.ring.read_latest()[1] is None:
+            if monotonic() - start_time > self.FIRST_FRAME_TIMEOUT_SEC:
+                self.stop()
+                raise IOError("the capture process did not produce a frame")
+            self.check_stages()
+            sleep(0.1)
+
+        if self.clip_buffer is not None:
+            self.clip_thread = Thread(target=self._feed_clip_buffer)
+            self.clip_thread.start()
+        return self
+
+    def _start_stage(self, name: str):
+        target, args = self.stage_targets[name]
+        stage = self.context.Process(target=target, args=args, name=f"owl-{name}", daemon=True)
+        stage.start()
+        self.stages[name] = stage
+
+    def check_stages(self):
+        """
+        restarts stages that crashed, call it periodically from the main loop
+        """
+        if self.stopped:
+            return
+
+        for name, stage in self.stages.items():
+            if stage.is_alive():
+                continue
+
+            # only recent crashes count, so an owl that runs for months isn't stopped by occasional ones
+            now = monotonic()
+            restart_times = self.restart_times[name]
+            while restart_times and now - restart_times[0] > self.RESTART_WINDOW_SEC:
+                restart_times.popleft()
+
+            if len(restart_times) >= self.MAX_RESTARTS:
+                # don't leave the other stage running, or the shared memory block behind
+                self.stop()
+                raise RuntimeError(f"the {name} process crashed {len(restart_times)} times within "
+                                   f"{self.RESTART_WINDOW_SEC} seconds, giving up")
+
+            restart_times.append(now)
+            print(f"the {name} process died with exit code {stage.exitcode}, restarting it "
+                  f"({len(restart_times)}/{self.MAX_RESTARTS} within {self.RESTART_WINDOW_SEC} seconds)")
+            self._start_stage(name)
+
+    def read(self):
+        # return the most recent frame
+        sequence, frame = self.ring.read_latest()
+        if frame is not None:
+            self.frame = frame
+        return self.frame
+
+    def poll_detections(self) -> Optional[DetectionRecord]:
+        """
+        returns the newest detection record that arrived since the last call, if any
+        """
+        record = None
+        while True:
+            try:
+                record = self.detections_queue.get_nowait()
+            except Empty:
+                return record
+
+    def _feed_clip_buffer(self):
+        while not self.stopped:
+            try:
+                frame_time, jpeg_bytes = self.clip_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            self.clip_buffer.add_jpeg(frame_time, jpeg_bytes)
+
+    def stop(self):
+        # called again by the owl's clean up after `check_stages` gave up
+        if self.is_closed:
+            return
+        self.is_closed = True
+
+        self.stopped = True
+        self.stop_event.set()
+        for stage in self.stages.values():
+            stage.join(self.JOIN_TIMEOUT_SEC)
+            if stage.is_alive():
+                stage.terminate()
+                stage.join()
+
+        if self.clip_thread is not None:
+            self.clip_thread.join()
+
+        self.detections_queue.close()
+        if self.clip_queue is not None:
+            self.clip_queue.close()
+        self.ring.close(unlink=True)
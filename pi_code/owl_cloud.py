@@ -0,0 +1,136 @@
+from datetime import datetime
+from threading import Thread
+from time import monotonic
+from typing import Any, Optional
+
+from pi_code.detection_history import DetectionHistory
+
+
+class OwlCloud:
+    """
+    the firebase side of the owl: remote commands, settings, and detection uploads.
+    has no camera, network or hardware imports, so the fleet simulator runs the same code as the owl.
+
+    the owl sets up `settings_db`, `commands_db`, `detections_db`, `detection_rollups_db`, `detections_storage`,
+    `history`, `mp3` and `servo_motors`, and calls `_init_cloud_state`.
+    """
+    STORAGE_BUCKET_NAME = "taken-images"
+    # detections that were not uploaded right away (duplicates) are published at most this often
+    METADATA_UPLOAD_INTERVAL_SEC = 60
+
+    def _init_cloud_state(self):
+        self.last_image_uploaded_url = None
+        self.notifies_detections = True
+        self.has_unpublished_detections = False
+        self.last_metadata_upload_time = 0.0
+
+        self.flap_wings_thread: Optional[Thread] = None
+        self.upload_metadata_thread: Optional[Thread] = None
+
+    @staticmethod
+    def is_thread_available(thread: Optional[Thread]):
+        return (thread is None) or (not thread.is_alive())
+
+    def check_realtime_commands(self):
+        """
+        this takes about half a second, depending on internet speed
+        """
+        my_device_commands = self.commands_db.get()
+        if my_device_commands is None:
+            return
+
+        assert isinstance(my_device_commands, dict), "device commands of wrong format"
+
+        for command in my_device_commands:
+            if my_device_commands[command]["applied"] == "false":
+                command_type = my_device_commands[command]["command"]
+                print(f"activating command {command} of type {command_type}")
+                self._run_command(command_type)
+                my_device_commands[command]["applied"] = "true"
+
+                specific_command_db = self.commands_db.child(command)
+                specific_command_db.set(my_device_commands[command])
+
+    def check_settings_changed(self):
+        settings: Any = self.settings_db.get()
+        self.mp3.muted = settings["mute"]
+        self.notifies_detections = settings["notify"]
+        self.servo_motors.fixed_head = settings["fixedHead"]
+        if not self.mp3.muted:
+            self.mp3.change_volume_setting(settings["volume"] / 100)
+
+        if self.servo_motors.fixed_head:
+            # does nothing without gpio
+            self.servo_motors.set_head_degree(settings["angle"])
+
+    def _play_sound_action(self, sound_file_name=None):
+        if sound_file_name is None:
+            sound_file_name = self.mp3.owl_screech
+
+        self.mp3.play_sound(sound_file_name=sound_file_name)
+
+    def _flap_wings_action(self):
+        if self.is_thread_available(self.flap_wings_thread):
+            self.flap_wings_thread = Thread(target=self.servo_motors.flap_wings)
+            self.flap_wings_thread.start()
+
+    def _stop_wings(self):
+        self.servo_motors.stop_flaps = True
+
+    def _run_command(self, command_type: str):
+        if command_type == "Trigger Alarm":
+            self._play_sound_action(sound_file_name=self.mp3.random_sound())
+            self._flap_wings_action()
+        elif command_type == "Stop Alarm":
+            self.mp3.stop_music()
+            self._stop_wings()
+
+    def _upload_frame_image(self, frame_image, full_blob_path, full_image_path):
+        frame_image.save(full_image_path)
+
+        print("uploading image to storage")
+        my_new_blob = self.detections_storage.blob(full_blob_path)
+        my_new_blob.upload_from_filename(filename=full_image_path, content_type="image/jpg")
+
+        blob_path_without_slash = full_blob_path.replace("/", "%2F")
+        real_url = f"https://firebasestorage.googleapis.com/v0/b/{self.STORAGE_BUCKET_NAME}/o/{blob_path_without_slash}?alt=media"
+
+        self.last_image_uploaded_url = real_url
+        print(f"uploaded image:{real_url}")
+
+    @staticmethod
+    def _get_timestamp():
+        now = datetime.now()
+        # year-month-day-hour-minute-second
+        timestamp = now.strftime(DetectionHistory.TIMESTAMP_FORMAT)
+        return timestamp
+
+    def _save_detection_metadata_action(self):
+        # the metadata is read from the local history, so if a previous upload is still running,
+        # `_publish_pending_detections` uploads this detection later
+        if self.is_thread_available(self.upload_metadata_thread):
+            self.has_unpublished_detections = False
+            self.last_metadata_upload_time = monotonic()
+            self.upload_metadata_thread = Thread(target=self.upload_detection_metadata)
+            self.upload_metadata_thread.start()
+
+    def _publish_pending_detections(self):
+        if (self.has_unpublished_detections and
+                monotonic() - self.last_metadata_upload_time >= self.METADATA_UPLOAD_INTERVAL_SEC):
+            self._save_detection_metadata_action()
+
+    def upload_detection_metadata(self):
+        if not self.history.is_cloud_list_imported():
+            # before the local history, the whole list was kept in the cloud. import it once,
+            # or this upload would replace it with only the detections since the update
+            cloud_detections = self.detections_db.get() or []
+            if isinstance(cloud_detections, dict):
+                cloud_detections = list(cloud_detections.values())
+            self.history.import_cloud_list(cloud_detections)
+
+        self.history.flush()
+        # the detections list only holds the most recent ones, older detections are in the rollups
+        self.detections_db.set(self.history.recent_detections())
+        self.detection_rollups_db.set(self.history.rollups())
+
+        print("detection metadata saved")
@@ -5,40 +5,46 @@ import json
 from datetime import datetime
 from pathlib import Path
 from threading import Thread
-import pygame
-from time import sleep
-from typing import List, Optional, Any
+from time import sleep, monotonic
+from typing import Optional, Any
 
 import cv2
 import firebase_admin
+import pygame
 import requests
 from PIL import Image
 from firebase_admin import credentials, db, storage
 
 from pi_code.bird_detection_network import BirdDetectionNetwork, USE_NETWORK
-from pi_code.servo_controller import ServoController, GPIO
+from pi_code.clip_recorder import ClipBuffer, ClipRecorder
+from pi_code.detection_history import DetectionHistory
+from pi_code.detection_trigger import DetectionTrigger
+from pi_code.model_registry import ModelRegistry
+from pi_code.multiprocess_runtime import MultiprocessRuntime
+from pi_code.owl_cloud import OwlCloud
+from pi_code.servo_controller import ServoController
+from pi_code.snapshot_dedup import SnapshotDeduplicator
 from pi_code.sound_player import SoundPlayer
+from pi_code.tiled_detection import TiledDetector
 from pi_code.video_stream import VideoStream
 
-pygame.init()
-
 GOOGLE_URL = "https://www.google.com/"
 GOOGLE_TIMEOUT = 5
-try:
-    request = requests.get(GOOGLE_URL, timeout=GOOGLE_TIMEOUT)
-    print("network is up")
-except (requests.ConnectionError, requests.Timeout) as exception:
-    print("network is dead. exiting")
-    exit(-1)
 
 
-class BigScaryOwl:
+def check_network():
+    try:
+        requests.get(GOOGLE_URL, timeout=GOOGLE_TIMEOUT)
+        print("network is up")
+    except (requests.ConnectionError, requests.Timeout):
+        print("network is dead. exiting")
+        exit(-1)
+
+
+class BigScaryOwl(OwlCloud):
     CWD = Path(__file__).parent
 
     # detections
-    MIN_BIRD_CONFIDENCE = 0.4
-    BIRD_LABEL = "bird"
-    MIN_SEC_BETWEEN_DETECTIONS = 5
     MIN_SEC_BETWEEN_TESTING = 20
 
     # firebase
@@ -48,27 +54,37 @@ class BigScaryOwl:
 
     DEVICE_ID = int(DEVICE_ID_FILEPATH.read_text())
     FIREBASE_KEY_FILE_PATH = CWD / "firebase_key.json"
-    STORAGE_BUCKET_NAME = "taken-images"
     DEFAULT_DB_URLS = {"databaseURL": "https://iot-project-f75da-default-rtdb.firebaseio.com/",
-                       "storageBucket": STORAGE_BUCKET_NAME}
+                       "storageBucket": OwlCloud.STORAGE_BUCKET_NAME}
 
     # notifications
     HEADERS_FILE_PATH = CWD / "notification_header.json"
     PAYLOAD_FILE_PATH = CWD / "notification_payload.json"
 
     def __init__(self):
-        self.bird_detection_scores: List = []
-        self.last_image_uploaded_url = None
-        self.last_detection_time = None
+        self._init_cloud_state()
 
         args = self._get_input_arguments()
         self.is_show_frame = bool(int(args.frame))
+        self.is_record_clips = bool(int(args.clip))
+        self.is_multiprocess = USE_NETWORK and bool(int(args.multiprocess))
         self.min_confidence_threshold = float(args.threshold)
         self.im_width, self.im_height = [int(val) for val in args.resolution.split('x')]
 
         # bird detection
+        if self.is_multiprocess:
+            # the network runs in the inference process, which sends us label names instead of class ids
+            self.trigger = DetectionTrigger()
+            self.last_detections = None
+        elif USE_NETWORK:
+            num_threads = BirdDetectionNetwork.DEFAULT_NUM_THREADS if args.threads is None else int(args.threads)
+            registry = ModelRegistry(num_threads=num_threads)
+            self.network: BirdDetectionNetwork = registry.load_network(args.model,
+                                                                       force_benchmark=bool(int(args.benchmark)))
+            self.trigger = DetectionTrigger(get_label=self.network.get_label)
+            self.tiled_detector = TiledDetector(self.network) if bool(int(args.tiles)) else None
+
         if USE_NETWORK:
-            self.network = BirdDetectionNetwork()
             self.network_input = None
             self.network_output = None
             self.network_loop_ticks = 0
@@ -91,8 +107,24 @@ class BigScaryOwl:
         # seconds between alarms, used for testing
         self.debug_action_gap = self.freq * 20
 
+        # all detections are kept locally, the app only gets rollups and the recent ones
+        self.history = DetectionHistory()
+
+        # snapshots of the same birds are not uploaded and notified about again
+        self.deduplicator = SnapshotDeduplicator(window_sec=float(args.dedup_window))
+
+        # detection clips
+        self.clip_buffer = ClipBuffer() if self.is_record_clips else None
+        self.clip_recorder = ClipRecorder(self.clip_buffer) if self.is_record_clips else None
+
         # video stream
-        self.videostream = VideoStream(resolution=(self.im_width, self.im_height)).start()
+        if self.is_multiprocess:
+            num_threads = MultiprocessRuntime.DEFAULT_NUM_THREADS if args.threads is None else int(args.threads)
+            self.videostream = MultiprocessRuntime(resolution=(self.im_width, self.im_height), model_name=args.model,
+                                                   num_threads=num_threads, is_tiled=bool(int(args.tiles)),
+                                                   clip_buffer=self.clip_buffer).start()
+        else:
+            self.videostream = VideoStream(resolution=(self.im_width, self.im_height), clip_buffer=self.clip_buffer).start()
 
         # initalize firebase app
         cred = credentials.Certificate(self.FIREBASE_KEY_FILE_PATH)
@@ -107,6 +139,7 @@ class BigScaryOwl:
         my_user_id = settings["assicatedUid"]
         self.notification_token_db = db.reference(f"/userdata/{my_user_id}/notificationToken")
         self.detections_db = db.reference(f"/users/{my_user_id}/detections/device/{self.DEVICE_ID}")
+        self.detection_rollups_db = db.reference(f"/users/{my_user_id}/detections/rollups/{self.DEVICE_ID}")
         self.commands_path = f"/users/{my_user_id}/commands/device/{self.DEVICE_ID}"
         self.commands_db = db.reference(self.commands_path)
 
@@ -117,13 +150,11 @@ class BigScaryOwl:
         self.settings_thread: Optional[Thread] = None
         self.rotate_thread: Optional[Thread] = None
         self.upload_image_thread: Optional[Thread] = None
+        self.upload_clip_thread: Optional[Thread] = None
         self.network_forward_thread: Optional[Thread] = None
-        self.flap_wings_thread: Optional[Thread] = None
         self.notify_thread: Optional[Thread] = None
-        self.upload_metadata_thread: Optional[Thread] = None
 
         # settings
-        self.notifies_detections = True
         print("reading initial settings")
         self.check_settings_changed()
 
@@ -138,42 +169,59 @@ class BigScaryOwl:
         parser.add_argument('--rightpin', help='right servo pin number', default=13)
         parser.add_argument('--leftpin', help='left servo pin number', default=15)
         parser.add_argument('--frame', default=1)
+        parser.add_argument('--clip', help='record a short clip around every detection', default=1)
+        parser.add_argument('--dedup-window', help='seconds in which detections of the same, unmoving birds '
+                                                   'are not uploaded again, 0 to upload all of them',
+                            default=SnapshotDeduplicator.WINDOW_SEC)
+        parser.add_argument('--tiles', help='also run the network on tiles of the frame, to find small birds',
+                            default=0)
+        parser.add_argument('--model', help='name of the tflite model to use, picked automatically by default',
+                            default=None)
+        parser.add_argument('--threads', help='number of interpreter threads, all cores by default '
+                                              '(the cores left after capture and I/O with --multiprocess=1)',
+                            default=None)
+        parser.add_argument('--multiprocess', help='run capture and inference in their own processes (python 3.8+)',
+                            default=0)
+        parser.add_argument('--benchmark', help='benchmark all models and pick the fastest, even if one was already picked',
+                            default=0)
         return parser.parse_args()
 
     def run_video_loop(self):
         print("press q (while focused on video) to quit")
-        while True:
-            self._update_ticks()
+        try:
+            while True:
+                self._update_ticks()
 
-            camera_frame = self.videostream.read()
-            livestream_frame = self._handle_frame_and_network(camera_frame)
+                camera_frame = self.videostream.read()
+                livestream_frame = self._handle_frame_and_network(camera_frame)
 
-            self.show_frame(livestream_frame)
+                self.show_frame(livestream_frame)
+                self._publish_pending_detections()
 
-            if self.is_thread_available(self.commands_thread):
-                self.commands_thread = Thread(target=self.check_realtime_commands)
-                self.commands_thread.start()
+                if self.is_thread_available(self.commands_thread):
+                    self.commands_thread = Thread(target=self.check_realtime_commands)
+                    self.commands_thread.start()
 
-            if self.is_thread_available(self.settings_thread):
-                self.settings_thread = Thread(target=self.check_settings_changed)
-                self.settings_thread.start()
+                if self.is_thread_available(self.settings_thread):
+                    self.settings_thread = Thread(target=self.check_settings_changed)
+                    self.settings_thread.start()
 
-            if (self.is_thread_available(self.rotate_thread) and
-                    self.is_thread_available(self.flap_wings_thread)):
-                self.rotate_thread = Thread(target=self.servo_motors.rotate_head)
-                self.rotate_thread.start()
+                if (self.is_thread_available(self.rotate_thread) and
+                        self.is_thread_available(self.flap_wings_thread)):
+                    self.rotate_thread = Thread(target=self.servo_motors.rotate_head)
+                    self.rotate_thread.start()
 
-            if cv2.waitKey(1) == ord('q'):
-                break
-
-        self._clean_up()
-
-    @staticmethod
-    def is_thread_available(thread: Optional[Thread]):
-        return (thread is None) or (not thread.is_alive())
+                if cv2.waitKey(1) == ord('q'):
+                    break
+        finally:
+            # also when a stage of the multiprocess runtime crashed too many times
+            self._clean_up()
 
     def _handle_frame_and_network(self, camera_frame):
-        if USE_NETWORK:
+        if self.is_multiprocess:
+            livestream_frame = self._handle_frame_and_pipeline(camera_frame)
+
+        elif USE_NETWORK:
             livestream_frame, input_data = self.network.transform_video_frame(camera_frame)
             detections = self.network.output_detection_results
 
@@ -188,14 +236,15 @@ class BigScaryOwl:
 
                 if detections is not None:
                     # a detection was complete, we need to analyze its results
-                    self._save_detection_score(detections)
                     uploaded_frame = livestream_frame.copy()
-                    now = datetime.now()
-                    if self._is_bird_high_confidence() and self._is_passed_time_since_last_detection(now):
-                        self.last_detection_time = now
+                    if self.trigger.update(detections, datetime.now()):
                         self._bird_detected_action(uploaded_frame)
 
-                self.network_forward_thread = Thread(target=self.network.run_image_through_network, args=(input_data,))
+                if self.tiled_detector is not None:
+                    self.network_forward_thread = Thread(target=self.tiled_detector.run_frame_through_network,
+                                                         args=(network_input_frame,))
+                else:
+                    self.network_forward_thread = Thread(target=self.network.run_image_through_network, args=(input_data,))
                 self.network_forward_thread.start()
 
         else:
@@ -205,11 +254,28 @@ class BigScaryOwl:
                 self.last_action_tick = self.cv2_ticks
         return livestream_frame
 
+    def _handle_frame_and_pipeline(self, camera_frame):
+        self.videostream.check_stages()
+        livestream_frame = camera_frame.copy()
+
+        record = self.videostream.poll_detections()
+        if record is not None:
+            # a detection was complete, we need to analyze its results
+            self._update_network_ticks()
+            self.last_detections = record.results
+            if self.trigger.update(record.results, datetime.now()):
+                self._bird_detected_action(livestream_frame.copy())
+
+        if self.last_detections is not None:
+            self._draw_confident_detections(livestream_frame, self.last_detections)
+        return livestream_frame
+
     def _clean_up(self):
         print("cleaning up, please wait...")
         self.kill_all_threads()
         cv2.destroyAllWindows()
         self.videostream.stop()
+        self.history.close()
         self.servo_motors.clean_up()
 
     def _update_ticks(self):
@@ -245,50 +311,39 @@ class BigScaryOwl:
         # loop over all detections and draw detection box if confidence is above minimum threshold
         for detection_id in range(len(scores)):
             curr_confidence = scores[detection_id]
-            curr_label = self.network.get_label(classes[detection_id])
+            curr_label = self.trigger.get_label(classes[detection_id])
 
             if (curr_confidence > self.min_confidence_threshold) and (curr_confidence <= 1.0):
                 self._draw_detection(boxes, curr_label, frame, detection_id, scores)
 
-    def _save_detection_score(self, detection_results):
-        boxes, classes, scores = detection_results
-
-        best_bird_score = 0
-        for detection_id in range(len(scores)):
-            curr_confidence = scores[detection_id]
-            curr_label = self.network.get_label(classes[detection_id])
-
-            if curr_label == self.BIRD_LABEL:
-                best_bird_score = max(best_bird_score, curr_confidence)
-
-        self.bird_detection_scores.append(best_bird_score)
-
-    def _is_bird_high_confidence(self, num_scores=1):
-        # look at the previous `num_scores` scores, and based on their average, decide if a bird was detected
-        if len(self.bird_detection_scores) > num_scores:
-            if sum(self.bird_detection_scores[-num_scores:]) / num_scores > self.MIN_BIRD_CONFIDENCE:
-                return True
-
-        return False
-
     def _bird_detected_action(self, frame):
         timestamp = self._get_timestamp()
-        confidence = (int(self.bird_detection_scores[-1] * 100)) if USE_NETWORK else 0
+        confidence = (int(self.trigger.last_score * 100)) if USE_NETWORK else 0
         print(f"bird detected at {timestamp} with {confidence}% confidence")
 
+        # the deterrent always goes off, even for birds we already reported
         self._play_sound_action(self.mp3.random_sound())
         self._flap_wings_action()
-        self._save_frame_action(frame, timestamp, confidence)
-        self._notify_detection_action()
-        self._save_detection_metadata_action(timestamp, confidence)
-
-        print(f"iterations={self.live_frame_count}")
 
-    def _play_sound_action(self, sound_file_name=None):
-        if sound_file_name is None:
-            sound_file_name = self.mp3.owl_screech
+        bird_box = self.trigger.last_bird_box if USE_NETWORK else None
+        detection_id = self.history.new_detection_id()
+        duplicate_of = self.deduplicator.find_duplicate(frame, bird_box, datetime.now(), detection_id)
+        # written by the history's writer thread, sqlite doesn't get to stall the video loop
+        self.history.queue_detection(timestamp, confidence, detection_id, duplicate_of)
+        self.has_unpublished_detections = True
+
+        if duplicate_of is not None:
+            print("same birds as a recent detection, not uploading it")
+            # it still counts in the rollups and in the suppressed count of the matched detection,
+            # which are published every now and then
+            self._publish_pending_detections()
+        else:
+            self._save_frame_action(frame, timestamp, confidence)
+            self._save_clip_action(timestamp, confidence)
+            self._notify_detection_action()
+            self._save_detection_metadata_action()
 
-        self.mp3.play_sound(sound_file_name=sound_file_name)
+        print(f"iterations={self.live_frame_count}")
 
     def _draw_detection(self, boxes, object_name, frame, i, scores):
         # get bounding box coordinates and draw box
@@ -309,41 +364,9 @@ class BigScaryOwl:
         cv2.rectangle(frame, (xmin, label_ymin - label_size[1] - 10), (xmin + label_size[0], label_ymin + base_line - 10), (255, 255, 255), cv2.FILLED)
         cv2.putText(frame, label, (xmin, label_ymin - 7), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
 
-    def check_realtime_commands(self):
-        """
-        this takes about half a second, depending on internet speed
-        """
-        my_device_commands = self.commands_db.get()
-        if my_device_commands is None:
-            return
-
-        assert isinstance(my_device_commands, dict), "device commands of wrong format"
-
-        for command in my_device_commands:
-            if my_device_commands[command]["applied"] == "false":
-                command_type = my_device_commands[command]["command"]
-                print(f"activating command {command} of type {command_type}")
-                self._run_command(command_type)
-                my_device_commands[command]["applied"] = "true"
-
-                specific_command_path = f"{self.commands_path}/{command}"
-                specific_command_db = db.reference(specific_command_path)
-                specific_command_db.set(my_device_commands[command])
-
-    def check_settings_changed(self):
-        settings: Any = self.settings_db.get()
-        self.mp3.muted = settings["mute"]
-        self.notifies_detections = settings["notify"]
-        self.servo_motors.fixed_head = settings["fixedHead"]
-        if not self.mp3.muted:
-            self.mp3.change_volume_setting(settings["volume"] / 100)
-
-        if self.servo_motors.fixed_head and GPIO is not None:
-            self.servo_motors.set_head_degree(settings["angle"])
-
     @property
     def all_threads(self):
-        return [self.commands_thread, self.settings_thread, self.upload_image_thread,
+        return [self.commands_thread, self.settings_thread, self.upload_image_thread, self.upload_clip_thread,
                 self.network_forward_thread, self.flap_wings_thread, self.notify_thread,
                 self.upload_metadata_thread, self.rotate_thread]
 
@@ -354,19 +377,6 @@ class BigScaryOwl:
             if thread:
                 thread.join()
 
-    def _flap_wings_action(self):
-        if self.is_thread_available(self.flap_wings_thread):
-            self.flap_wings_thread = Thread(target=self.servo_motors.flap_wings)
-            self.flap_wings_thread.start()
-
-    def _run_command(self, command_type: str):
-        if command_type == "Trigger Alarm":
-            self._play_sound_action(sound_file_name=self.mp3.random_sound())
-            self._flap_wings_action()
-        elif command_type == "Stop Alarm":
-            self.mp3.stop_music()
-            self._stop_wings()
-
     def _save_frame_action(self, frame, timestamp, confidence):
         frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         frame_image = Image.fromarray(frame_rgb)
@@ -379,25 +389,32 @@ class BigScaryOwl:
             self.upload_image_thread = Thread(target=self._upload_frame_image, args=(frame_image, full_blob_path, full_image_path))
             self.upload_image_thread.start()
 
-    def _upload_frame_image(self, frame_image, full_blob_path, full_image_path):
-        frame_image.save(full_image_path)
+    def _save_clip_action(self, timestamp, confidence):
+        if not self.is_record_clips:
+            return
 
-        print("uploading image to storage")
-        my_new_blob = self.detections_storage.blob(full_blob_path)
-        my_new_blob.upload_from_filename(filename=full_image_path, content_type="image/jpg")
+        full_clip_name = f"{timestamp}_{confidence}{ClipRecorder.SUFFIX}"
+        full_blob_path = f"{self.DEVICE_ID}/{ClipRecorder.STORAGE_FOLDER}/{full_clip_name}"
+        full_clip_path = self.CWD / "images" / full_clip_name
 
-        blob_path_without_slash = full_blob_path.replace("/", "%2F")
-        real_url = f"https://firebasestorage.googleapis.com/v0/b/{self.STORAGE_BUCKET_NAME}/o/{blob_path_without_slash}?alt=media"
+        if self.is_thread_available(self.upload_clip_thread):
+            self.upload_clip_thread = Thread(target=self._upload_clip, args=(monotonic(), full_blob_path, full_clip_path))
+            self.upload_clip_thread.start()
 
-        self.last_image_uploaded_url = real_url
-        print(f"uploaded image:{real_url}")
+    def _upload_clip(self, trigger_time, full_blob_path, full_clip_path):
+        # waits for the post-roll, so the clip is uploaded a few seconds after the still
+        clip_path = self.clip_recorder.record_clip(trigger_time, full_clip_path)
+        if clip_path is None:
+            return
 
-    @staticmethod
-    def _get_timestamp():
-        now = datetime.now()
-        # year-month-day-hour-minute-second
-        timestamp = now.strftime("%Y-%m-%d-%H-%M-%S")
-        return timestamp
+        try:
+            print("uploading clip to storage")
+            my_new_blob = self.detections_storage.blob(full_blob_path)
+            my_new_blob.upload_from_filename(filename=str(clip_path), content_type=ClipRecorder.CONTENT_TYPE)
+            print(f"uploaded clip:{full_blob_path}")
+        finally:
+            # clips are only written to be uploaded, and are too big to pile up on the sd card
+            clip_path.unlink()
 
     def _notify_detection_action(self):
         if self.notifies_detections:
@@ -419,35 +436,8 @@ class BigScaryOwl:
         response = requests.post(url, headers=headers_dict, data=payload_json)
         print(f"notification response: {response.text}")
 
-    def _save_detection_metadata_action(self, timestamp, confidence):
-        if self.is_thread_available(self.upload_metadata_thread):
-            self.upload_metadata_thread = Thread(target=self.upload_detection_metadata, args=(confidence, timestamp))
-            self.upload_metadata_thread.start()
-
-    def upload_detection_metadata(self, confidence, timestamp):
-        curr_detection_dict = {"time": timestamp, "confidence": confidence}
-
-        all_my_detections = self.detections_db.get()
-        if all_my_detections is None:
-            self.detections_db.set([curr_detection_dict])
-        else:
-            assert isinstance(all_my_detections, list)
-            all_my_detections.append(curr_detection_dict)
-            self.detections_db.set(all_my_detections)
-
-        print("detection metadata saved")
-
-    def _stop_wings(self):
-        self.servo_motors.stop_flaps = True
-
-    def _is_passed_time_since_last_detection(self, now):
-        if self.last_detection_time is None:
-            return True
-
-        delta = (now - self.last_detection_time).seconds
-        enough_time_passed = delta > self.MIN_SEC_BETWEEN_DETECTIONS
-        return enough_time_passed
-
 
 if __name__ == "__main__":
+    pygame.init()
+    check_network()
     BigScaryOwl().run_video_loop()
@@ -0,0 +1,77 @@
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+def perceptual_hash(frame) -> int:
+    """
+    64 bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour.
+    nearly identical frames get hashes that differ in only a few bits.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    thumbnail = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distance(first_hash: int, second_hash: int) -> int:
+    return bin(first_hash ^ second_hash).count("1")
+
+
+def box_iou(first_box, second_box) -> float:
+    ymin = max(first_box[0], second_box[0])
+    xmin = max(first_box[1], second_box[1])
+    ymax = min(first_box[2], second_box[2])
+    xmax = min(first_box[3], second_box[3])
+    intersection = max(0.0, ymax - ymin) * max(0.0, xmax - xmin)
+    first_area = (first_box[2] - first_box[0]) * (first_box[3] - first_box[1])
+    second_area = (second_box[2] - second_box[0]) * (second_box[3] - second_box[1])
+    union = first_area + second_area - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class SnapshotDeduplicator:
+    """
+    recognizes detections of the same, unmoving birds, so we don't upload and notify about them again.
+    a snapshot is a duplicate if a recent one has a close perceptual hash, and a bird box in the same place.
+    """
+    WINDOW_SEC = 120
+    MAX_HASH_DISTANCE = 6
+    MIN_BOX_IOU = 0.5
+
+    def __init__(self, window_sec=WINDOW_SEC, max_hash_distance=MAX_HASH_DISTANCE, min_box_iou=MIN_BOX_IOU):
+        self.window = timedelta(seconds=window_sec)
+        self.max_hash_distance = max_hash_distance
+        self.min_box_iou = min_box_iou
+
+        # (last seen, hash, bird box, detection id) of recent snapshots
+        self.recent: Deque[Tuple[datetime, int, Optional[np.ndarray], int]] = deque()
+
+    def find_duplicate(self, frame, bird_box, now: datetime, detection_id: int) -> Optional[int]:
+        """
+        returns the detection id of the recent snapshot that `frame` duplicates, so its suppressed
+        count can be increased. if there is none, `frame` is remembered as the snapshot of `detection_id`.
+        """
+        if self.window.total_seconds() <= 0:
+            return None
+
+        while self.recent and now - self.recent[0][0] > self.window:
+            self.recent.popleft()
+
+        frame_hash = perceptual_hash(frame)
+        for index, (_, recent_hash, recent_box, recent_id) in enumerate(self.recent):
+            if hamming_distance(frame_hash, recent_hash) > self.max_hash_distance:
+                continue
+            if bird_box is not None and recent_box is not None and box_iou(bird_box, recent_box) < self.min_box_iou:
+                continue
+
+            # the birds are still there, keep the snapshot alive for another window
+            del self.recent[index]
+            self.recent.append((now, recent_hash, recent_box, recent_id))
+            return recent_id
+
+        self.recent.append((now, frame_hash, bird_box, detection_id))
+        return None
@@ -0,0 +1,154 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from pi_code.bird_detection_network import BirdDetectionNetwork
+from pi_code.detection_trigger import DetectionTrigger
+
+
+def non_max_suppression(boxes: np.ndarray, classes: np.ndarray, scores: np.ndarray,
+                        iou_threshold: float) -> np.ndarray:
+    """
+    returns the indices of the boxes to keep, best score first.
+    boxes are [ymin, xmin, ymax, xmax], and only boxes of the same class suppress each other.
+    """
+    if len(scores) == 0:
+        return np.zeros(0, dtype=int)
+
+    # pairwise IoU of all boxes at once
+    ymin = np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    xmin = np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    ymax = np.minimum(boxes[:, None, 2], boxes[None, :, 2])
+    xmax = np.minimum(boxes[:, None, 3], boxes[None, :, 3])
+    intersection = np.clip(ymax - ymin, 0, None) * np.clip(xmax - xmin, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = areas[:, None] + areas[None, :] - intersection
+    iou = intersection / np.maximum(union, 1e-9)
+    overlapping = (iou > iou_threshold) & (classes[:, None] == classes[None, :])
+
+    order = np.argsort(-scores)
+    suppressed = np.zeros(len(scores), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= overlapping[i]
+    return np.array(keep, dtype=int)
+
+
+class TiledDetector:
+    """
+    runs the network over the full frame, plus a few overlapping tiles of it per pass,
+    so small, distant birds are not shrunk down to a few pixels.
+    tiles that recently had birds in them are visited more often, and every pass costs at most
+    1 + `tiles_per_pass` invokes.
+    """
+    # columns x rows, 3x2 keeps the tiles close to square on 16:9 frames
+    GRID = (3, 2)
+    TILE_OVERLAP = 0.15
+    TILES_PER_PASS = 2
+
+    # scheduling
+    ACTIVITY_DECAY = 0.8
+    STALENESS_WEIGHT = 0.25
+    MIN_ACTIVITY_SCORE = 0.3
+
+    # merging
+    NMS_IOU_THRESHOLD = 0.5
+    MAX_DETECTIONS = 10
+
+    def __init__(self, network: BirdDetectionNetwork, grid=GRID, tile_overlap=TILE_OVERLAP,
+                 tiles_per_pass=TILES_PER_PASS):
+        self.network = network
+        self.tiles = self._make_tiles(grid, tile_overlap)
+        self.tiles_per_pass = min(tiles_per_pass, len(self.tiles))
+
+        self.reset()
+
+    def reset(self):
+        # recent bird activity of every tile, and the number of passes since it was last visited
+        self.activity = np.zeros(len(self.tiles))
+        self.passes_since_visit = np.zeros(len(self.tiles))
+
+    @staticmethod
+    def _make_tiles(grid: Tuple[int, int], tile_overlap: float) -> np.ndarray:
+        # normalized [ymin, xmin, ymax, xmax] of every tile
+        columns, rows = grid
+        tiles = []
+        for row in range(rows):
+            for column in range(columns):
+                ymin = max(0.0, (row - tile_overlap) / rows)
+                xmin = max(0.0, (column - tile_overlap) / columns)
+                ymax = min(1.0, (row + 1 + tile_overlap) / rows)
+                xmax = min(1.0, (column + 1 + tile_overlap) / columns)
+                tiles.append([ymin, xmin, ymax, xmax])
+        return np.array(tiles)
+
+    def schedule_tiles(self) -> List[int]:
+        # active tiles come first, but a tile that was skipped for long enough gets its turn too
+        priority = self.activity + self.STALENESS_WEIGHT * self.passes_since_visit
+        return [int(tile_id) for tile_id in np.argsort(-priority)[:self.tiles_per_pass]]
+
+    def run_frame_through_network(self, frame):
+        # same interface as `BirdDetectionNetwork.run_image_through_network`, for the network thread
+        self.network.is_busy = True
+        self.network.output_detection_results = self.detect_frame(frame)
+        self.network.is_busy = False
+
+    def detect_frame(self, frame):
+        """
+        returns (boxes, classes, scores) like `BirdDetectionNetwork.detect`, with boxes relative to the full frame
+        """
+        frame_height, frame_width = frame.shape[:2]
+        all_boxes = []
+        all_classes = []
+        all_scores = []
+
+        boxes, classes, scores = self.network.detect(self.network.prepare_input(frame))
+        all_boxes.append(boxes)
+        all_classes.append(classes)
+        all_scores.append(scores)
+        self._update_activity_from_full_frame(boxes, classes, scores)
+
+        visited_tiles = self.schedule_tiles()
+        self.activity *= self.ACTIVITY_DECAY
+        self.passes_since_visit += 1
+        for tile_id in visited_tiles:
+            ymin, xmin, ymax, xmax = self.tiles[tile_id]
+            tile = frame[int(ymin * frame_height):int(ymax * frame_height),
+                         int(xmin * frame_width):int(xmax * frame_width)]
+            boxes, classes, scores = self.network.detect(self.network.prepare_input(tile))
+
+            # map the boxes from tile coordinates back to the full frame
+            scale = np.array([ymax - ymin, xmax - xmin, ymax - ymin, xmax - xmin])
+            offset = np.array([ymin, xmin, ymin, xmin])
+            all_boxes.append(boxes * scale + offset)
+            all_classes.append(classes)
+            all_scores.append(scores)
+
+            self.activity[tile_id] = max(self.activity[tile_id], self._best_bird_score(classes, scores))
+            self.passes_since_visit[tile_id] = 0
+
+        boxes = np.concatenate(all_boxes)
+        classes = np.concatenate(all_classes)
+        scores = np.concatenate(all_scores)
+        keep = non_max_suppression(boxes, classes, scores, self.NMS_IOU_THRESHOLD)[:self.MAX_DETECTIONS]
+        return boxes[keep], classes[keep], scores[keep]
+
+    def _best_bird_score(self, classes, scores) -> float:
+        bird_scores = [score for class_id, score in zip(classes, scores)
+                       if score > self.MIN_ACTIVITY_SCORE and
+                       self.network.get_label(class_id) == DetectionTrigger.BIRD_LABEL]
+        return max(bird_scores, default=0.0)
+
+    def _update_activity_from_full_frame(self, boxes, classes, scores):
+        # birds seen in the full frame pass make the tiles around them more interesting
+        for box, class_id, score in zip(boxes, classes, scores):
+            if score <= self.MIN_ACTIVITY_SCORE or self.network.get_label(class_id) != DetectionTrigger.BIRD_LABEL:
+                continue
+            center_y = (box[0] + box[2]) / 2
+            center_x = (box[1] + box[3]) / 2
+            containing = ((self.tiles[:, 0] <= center_y) & (center_y <= self.tiles[:, 2]) &
+                          (self.tiles[:, 1] <= center_x) & (center_x <= self.tiles[:, 3]))
+            self.activity[containing] = np.maximum(self.activity[containing], score)
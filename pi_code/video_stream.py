@@ -1,12 +1,15 @@
 from threading import Thread
+from typing import Optional
 
 import cv2
 
+from pi_code.clip_recorder import ClipBuffer
+
 
 class VideoStream:
     """camera object that controls video streaming from the Picamera"""
 
-    def __init__(self, resolution=(640, 480)):
+    def __init__(self, resolution=(640, 480), clip_buffer: Optional[ClipBuffer] = None):
         # initialize the PiCamera and the camera image stream
         print("setting up cv2 video, this takes ~5 seconds...")
         self.stream = cv2.VideoCapture(0)
@@ -17,6 +20,9 @@ class VideoStream:
         # read first frame from the stream
         (self.grabbed, self.frame) = self.stream.read()
 
+        # recent frames are also kept encoded, for detection clips
+        self.clip_buffer = clip_buffer
+
         # variable to control when the camera is stopped
         self.stopped = False
 
@@ -36,6 +42,8 @@ class VideoStream:
 
             # otherwise, grab the next frame from the stream
             (self.grabbed, self.frame) = self.stream.read()
+            if self.grabbed and self.clip_buffer is not None:
+                self.clip_buffer.add_frame(self.frame)
 
     def read(self):
         # return the most recent frame